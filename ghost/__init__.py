@@ -1,16 +1,46 @@
 from .ghost import (
+    Blocklist,
+    CannedResponse,
     Ghost,
     Error,
+    HarArchive,
+    HttpCache,
+    ImageEncoder,
+    LoadingProfile,
+    Metrics,
+    RequestScheduler,
+    ResourcePolicy,
     Session,
+    SessionPool,
     TimeoutError,
+    Tracer,
+    stitch_tiles,
 )
+from .aio import AsyncGhost, AsyncSession
+from .farm import GhostFarm, WorkerError
 from .test import GhostTestCase
 
 
 __all__ = [
+    'AsyncGhost',
+    'AsyncSession',
+    'Blocklist',
+    'CannedResponse',
     'Ghost',
     'Error',
+    'HarArchive',
+    'HttpCache',
+    'ImageEncoder',
+    'LoadingProfile',
+    'Metrics',
+    'RequestScheduler',
+    'ResourcePolicy',
     'Session',
+    'SessionPool',
     'TimeoutError',
+    'Tracer',
+    'stitch_tiles',
+    'GhostFarm',
     'GhostTestCase',
+    'WorkerError',
 ]
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+
+class QtEventPump(object):
+    """Processes Qt events from an asyncio event loop while ghost futures
+    are awaited, so that coroutines awaiting pages don't block each other.
+
+    Qt doesn't expose its event sources (X connection, sockets, timers) to
+    asyncio, so this polls: pending Qt events are processed every
+    `interval` seconds while futures are awaited. Each Qt event may hence
+    be handled up to `interval` late, and the process wakes up every
+    `interval` meanwhile, rather than sleeping like `Session` blocking
+    waits do. Nothing is polled while no future is awaited.
+
+    :param ghost: The `Ghost` instance.
+    :param interval: The delay in second between two Qt events processing.
+    """
+    def __init__(self, ghost, interval=0.005):
+        self.ghost = ghost
+        self.interval = interval
+        self._users = 0
+        self._task = None
+
+    async def wait(self, future):
+        """Awaits a concurrent Future resolved by Qt signals.
+
+        :param future: A future returned by a `Session` `*_async` method.
+        """
+        self._users += 1
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._pump())
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            self._users -= 1
+
+    async def _pump(self):
+        try:
+            while self._users:
+                self.ghost._app.processEvents()
+                await asyncio.sleep(self.interval)
+        finally:
+            self._task = None
+
+
+class AsyncSession(object):
+    """asyncio front-end of a `Session`. Methods that aren't overridden
+    are the blocking `Session` ones.
+
+    :param session: The `Session` to drive.
+    :param pump: The `QtEventPump` that processes Qt events.
+    """
+    def __init__(self, session, pump):
+        self.session = session
+        self.pump = pump
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    async def open(self, address, timeout=None, **kwargs):
+        """Opens a web page, see `Session.open()`."""
+        return await self.pump.wait(
+            self.session.open_async(address, timeout=timeout, **kwargs))
+
+    async def wait_for_page_loaded(self, timeout=None):
+        """See `Session.wait_for_page_loaded()`."""
+        return await self.pump.wait(
+            self.session.wait_for_page_loaded_async(timeout=timeout))
+
+    async def wait_for_selector(self, selector, timeout=None):
+        """See `Session.wait_for_selector()`."""
+        return await self.pump.wait(
+            self.session.wait_for_selector_async(selector, timeout=timeout))
+
+    async def wait_while_selector(self, selector, timeout=None):
+        """See `Session.wait_while_selector()`."""
+        return await self.pump.wait(
+            self.session.wait_while_selector_async(selector, timeout=timeout))
+
+    async def wait_for_text(self, text, timeout=None, selector=None,
+                            regex=False, rendered=False):
+        """See `Session.wait_for_text()`."""
+        return await self.pump.wait(self.session.wait_for_text_async(
+            text,
+            timeout=timeout,
+            selector=selector,
+            regex=regex,
+            rendered=rendered,
+        ))
+
+    async def wait_for_alert(self, timeout=None):
+        """See `Session.wait_for_alert()`."""
+        return await self.pump.wait(
+            self.session.wait_for_alert_async(timeout=timeout))
+
+    async def evaluate(self, script, expect_loading=False, timeout=None):
+        """Evaluates script in page frame, see `Session.evaluate()`.
+
+        The script itself runs synchronously on the Qt thread, only the
+        page loading it may trigger is awaited.
+        """
+        if expect_loading:
+            self.session.loaded = False
+        result = self.session.evaluate(script)
+        if expect_loading:
+            return await self.wait_for_page_loaded(timeout=timeout)
+        await asyncio.sleep(0)
+        return result
+
+    async def capture(self, **kwargs):
+        """Returns snapshot as QImage, see `Session.capture()`.
+
+        Rendering happens synchronously on the Qt thread.
+        """
+        image = self.session.capture(**kwargs)
+        await asyncio.sleep(0)
+        return image
+
+    async def __aenter__(self):
+        return self
+
+    async def exit(self):
+        """Exits the session, see `Session.exit()`, without blocking the
+        asyncio loop while Qt deletes the page.
+        """
+        return await self.pump.wait(self.session.exit_async())
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.exit()
+
+
+class AsyncGhost(object):
+    """Starts `AsyncSession` instances sharing a `QtEventPump`.
+
+    :param ghost: The `Ghost` instance.
+    :param interval: The delay in second between two Qt events processing.
+    """
+    def __init__(self, ghost, interval=0.005):
+        self.ghost = ghost
+        self.pump = QtEventPump(ghost, interval=interval)
+
+    def start(self, **kwargs):
+        """Starts a new `AsyncSession`, see `Ghost.start()`."""
+        return AsyncSession(self.ghost.start(**kwargs), self.pump)
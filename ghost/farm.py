@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+
+from PySide2.QtCore import QBuffer, QByteArray, QIODevice
+
+from .ghost import Error, Ghost
+
+
+logger = logging.getLogger('ghost.farm')
+
+
+class WorkerError(Error):
+    """Raised when a job fails or its worker dies."""
+    pass
+
+
+def fetch(
+    session,
+    url,
+    selector=None,
+    content=True,
+    screenshot=False,
+    resources=False,
+    timeout=None,
+):
+    """Job that opens given URL and returns what has been asked for as a
+    dict.
+
+    :param session: The worker `Session`.
+    :param url: The URL to open.
+    :param selector: An optional selector to wait for.
+    :param content: Whether to return the frame HTML.
+    :param screenshot: Whether to return a PNG screenshot.
+    :param resources: Whether to return the loaded resources url, status
+        and headers.
+    :param timeout: An optional timeout.
+    """
+    page, loaded = session.open(url, timeout=timeout)
+    if selector is not None:
+        _, extra = session.wait_for_selector(selector, timeout=timeout)
+        loaded.extend(extra)
+
+    result = {
+        'url': session.main_frame.url().toString(),
+        'http_status': page.http_status if page is not None else None,
+    }
+    if content:
+        result['content'] = session.content
+    if screenshot:
+        data = QByteArray()
+        buffer_ = QBuffer(data)
+        buffer_.open(QIODevice.WriteOnly)
+        session.capture().save(buffer_, 'PNG')
+        result['screenshot'] = bytes(data.data())
+    if resources:
+        result['resources'] = [
+            dict(url=r.url, http_status=r.http_status, headers=r.headers)
+            for r in loaded
+        ]
+    return result
+
+
+def _rss():
+    """Returns the current process resident set size in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _work(index, jobs, results, max_jobs, max_rss, own_display,
+          ghost_kwargs, session_kwargs):
+    """Worker process main loop."""
+    if own_display:
+        # Makes Ghost start its own Xvfb.
+        os.environ.pop('DISPLAY', None)
+    try:
+        ghost = Ghost(**ghost_kwargs)
+        pool = ghost.pool(max_size=1, **session_kwargs)
+    except Exception:
+        results.put(('crashed', index, None, traceback.format_exc()))
+        raise
+    results.put(('ready', index, None, None))
+    done = 0
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            job_id, func, args, kwargs = job
+            results.put(('started', index, job_id, None))
+            try:
+                with pool.session() as session:
+                    value = func(session, *args, **kwargs)
+            except Exception as e:
+                try:
+                    pickle.dumps(e)
+                except Exception:
+                    e = WorkerError(traceback.format_exc())
+                results.put(('failed', index, job_id, e))
+            else:
+                # Unpicklable values would be lost by the queue feeder.
+                try:
+                    pickle.dumps(value)
+                except Exception:
+                    results.put(('failed', index, job_id, WorkerError(
+                        'Job result can\'t be pickled:\n%s' %
+                        traceback.format_exc(),
+                    )))
+                else:
+                    results.put(('done', index, job_id, value))
+
+            done += 1
+            if (
+                (max_jobs and done >= max_jobs) or
+                (max_rss and _rss() > max_rss)
+            ):
+                results.put(('recycled', index, None, None))
+                break
+    finally:
+        pool.close()
+        ghost.exit()
+
+
+class GhostFarm(object):
+    """`GhostFarm` runs jobs in several worker processes, each with its own
+    `Ghost` (and Xvfb display), as a Qt application can only drive pages
+    from a single thread.
+
+    A job is a picklable callable taking a `Session` as first argument;
+    its arguments and return value have to be picklable too, jobs that
+    don't fail with a `WorkerError`. Workers are recycled after `max_jobs`
+    jobs or once their RSS exceeds `max_rss` bytes, and restarted when they
+    crash. Once workers died `max_start_failures` times in a row before
+    being ready, the farm is broken: pending and new jobs fail with a
+    `WorkerError`.
+
+    :param workers: The number of worker processes, defaults to the number
+        of CPUs.
+    :param max_jobs: An optional number of jobs after which a worker gets
+        recycled.
+    :param max_rss: An optional resident memory size in bytes after which
+        a worker gets recycled.
+    :param own_display: Starts an Xvfb per worker even if DISPLAY is set.
+    :param max_start_failures: The number of workers in a row that can
+        die at startup before the farm gives up.
+    :param ghost_kwargs: The arguments to build workers `Ghost` with.
+    :param session_kwargs: The arguments to start workers sessions with.
+    """
+    def __init__(
+        self,
+        workers=None,
+        max_jobs=None,
+        max_rss=None,
+        own_display=True,
+        max_start_failures=3,
+        ghost_kwargs=None,
+        **session_kwargs
+    ):
+        self.size = workers or multiprocessing.cpu_count()
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.own_display = own_display
+        self.max_start_failures = max_start_failures
+        self.ghost_kwargs = ghost_kwargs or {}
+        self.session_kwargs = session_kwargs
+        self._context = multiprocessing.get_context('spawn')
+        self._jobs = self._context.Queue()
+        self._results = self._context.Queue()
+        self._workers = {}
+        self._running = {}
+        self._futures = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._collector = None
+        self._closing = False
+        self._stopping = False
+        self._ready = set()
+        self._start_failures = 0
+        self._start_error = None
+        self._broken = None
+
+    def start(self):
+        """Starts the worker processes."""
+        for index in range(self.size):
+            self._start_worker(index)
+        self._collector = threading.Thread(target=self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+        return self
+
+    def submit(self, func, *args, **kwargs):
+        """Queues a job.
+
+        :param func: The job callable.
+        :return: A `concurrent.futures.Future` resolved with the job result.
+        """
+        future = Future()
+        try:
+            pickle.dumps((func, args, kwargs))
+        except Exception:
+            future.set_exception(WorkerError(traceback.format_exc()))
+            return future
+        with self._lock:
+            if self._broken is not None:
+                future.set_exception(WorkerError(self._broken))
+                return future
+            job_id = next(self._ids)
+            self._futures[job_id] = future
+        self._jobs.put((job_id, func, args, kwargs))
+        return future
+
+    def fetch(self, url, **kwargs):
+        """Queues a `fetch` job.
+
+        :param url: The URL to open.
+        """
+        return self.submit(fetch, url, **kwargs)
+
+    def stop(self, timeout=10):
+        """Stops the worker processes and fails the pending jobs.
+
+        :param timeout: The number of seconds to wait for each worker.
+        """
+        self._closing = True
+        for _ in self._workers:
+            self._jobs.put(None)
+        for process in self._workers.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._stopping = True
+        if self._collector is not None:
+            self._collector.join()
+        self._drain()
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            if not future.done():
+                future.set_exception(WorkerError('Farm stopped'))
+
+    def _start_worker(self, index):
+        process = self._context.Process(
+            target=_work,
+            args=(
+                index,
+                self._jobs,
+                self._results,
+                self.max_jobs,
+                self.max_rss,
+                self.own_display,
+                self.ghost_kwargs,
+                self.session_kwargs,
+            ),
+        )
+        process.daemon = True
+        process.start()
+        self._workers[index] = process
+        self._ready.discard(index)
+        logger.info('Worker %s started (pid %s)', index, process.pid)
+
+    def _collect(self):
+        """Resolves futures from workers messages and restarts dead
+        workers.
+        """
+        while not self._stopping:
+            try:
+                self._handle(*self._results.get(timeout=0.5))
+            except queue.Empty:
+                pass
+            self._check_workers()
+
+    def _handle(self, message, index, job_id, value):
+        if message == 'ready':
+            self._ready.add(index)
+            self._start_failures = 0
+            return
+        if message == 'crashed':
+            logger.error('Worker %s failed to start:\n%s', index, value)
+            self._start_error = value
+            return
+        if message == 'started':
+            self._running[index] = job_id
+            return
+        if message == 'recycled':
+            logger.info('Recycling worker %s', index)
+            return
+        self._running.pop(index, None)
+        with self._lock:
+            future = self._futures.pop(job_id, None)
+        if future is None:
+            return
+        if message == 'done':
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def _check_workers(self):
+        for index, process in list(self._workers.items()):
+            if process.is_alive() or self._closing:
+                continue
+            # Handles messages sent right before the process exited.
+            self._drain()
+            process.join()
+            job_id = self._running.pop(index, None)
+            if job_id is not None:
+                logger.error(
+                    'Worker %s died (exit code %s) running job %s',
+                    index,
+                    process.exitcode,
+                    job_id,
+                )
+                with self._lock:
+                    future = self._futures.pop(job_id, None)
+                if future is not None:
+                    future.set_exception(WorkerError(
+                        'Worker died (exit code %s)' % process.exitcode,
+                    ))
+            if index not in self._ready:
+                self._start_failures += 1
+                if self._start_failures >= self.max_start_failures:
+                    self._break(
+                        'Workers died at startup %s times in a row '
+                        '(exit code %s)' % (
+                            self._start_failures,
+                            process.exitcode,
+                        ),
+                    )
+                    del self._workers[index]
+                    continue
+            self._start_worker(index)
+
+    def _break(self, message):
+        """Gives up restarting workers and fails the pending jobs."""
+        if self._start_error is not None:
+            message += ':\n%s' % self._start_error
+        logger.error(message)
+        with self._lock:
+            self._broken = message
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            if not future.done():
+                future.set_exception(WorkerError(message))
+
+    def _drain(self):
+        while True:
+            try:
+                self._handle(*self._results.get_nowait())
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
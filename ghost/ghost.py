@@ -2,13 +2,22 @@ import sys
 import os
 import time
 import uuid
+import base64
 import codecs
+import hashlib
+import itertools
+import json
 import logging
+import mmap
 import re
+import tempfile
 
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
 from http.cookiejar import Cookie, LWPCookieJar
 from contextlib import contextmanager
-from functools import wraps
+from functools import partial, wraps
 
 from PySide2.QtWebKitWidgets import (
     QWebPage,
@@ -16,9 +25,17 @@ from PySide2.QtWebKitWidgets import (
     QWebView,
 )
 from PySide2.QtCore import (
+    QAbstractEventDispatcher,
+    QBuffer,
     QByteArray,
     QDateTime,
+    QEventLoop,
+    QIODevice,
     qInstallMessageHandler,
+    QMetaObject,
+    QObject,
+    QPoint,
+    QRect,
     QSize,
     QSizeF,
     Qt,
@@ -26,10 +43,14 @@ from PySide2.QtCore import (
     QtDebugMsg,
     QtFatalMsg,
     QtWarningMsg,
+    QTimer,
     QUrl,
+    Slot,
 )
 from PySide2.QtGui import (
     QImage,
+    QImageReader,
+    QImageWriter,
     QPainter,
     QRegion,
 )
@@ -41,7 +62,9 @@ from PySide2.QtNetwork import (
     QNetworkAccessManager,
     QNetworkCookie,
     QNetworkCookieJar,
+    QNetworkDiskCache,
     QNetworkProxy,
+    QNetworkReply,
     QNetworkRequest,
 )
 from xvfbwrapper import Xvfb
@@ -112,6 +135,7 @@ class GhostWebPage(QWebPage):
         self.session._alert = message
         self.session.append_popup_message(message)
         self.session.logger.info("alert('%s')", message)
+        self.session._wake_up()
 
     def _get_value(self, value):
         if callable(value):
@@ -131,6 +155,7 @@ class GhostWebPage(QWebPage):
         self.session.append_popup_message(message)
         value = self.session._confirm_expected
         self.session.logger.info("confirm('%s')", message)
+        self.session._wake_up()
         return self._get_value(value)
 
     def javaScriptPrompt(self, frame, message, defaultValue, result=None):
@@ -145,6 +170,7 @@ class GhostWebPage(QWebPage):
         self.session.append_popup_message(message)
         value = self.session._prompt_expected
         self.session.logger.info("prompt('%s')", message)
+        self.session._wake_up()
         value = self._get_value(value)
         if value == '':
             self.session.logger.warning(
@@ -165,35 +191,389 @@ class GhostWebPage(QWebPage):
         return self.user_agent
 
 
+class GhostBridge(QObject):
+    """Exposed to page scripts as `ghostBridge`, so that they can notify
+    the session of DOM events.
+    """
+    def __init__(self, session):
+        self.session = session
+        super(GhostBridge, self).__init__()
+
+    @Slot(int)
+    def notify(self, observer_id):
+        self.session.logger.debug('DOM observer %s notified', observer_id)
+        # Leaves the script context before checking wait conditions.
+        QTimer.singleShot(0, self.session._wake_up)
+
+
 def can_load_page(func):
     """Decorator that specifies if user can expect page loading from
     this action. If expect_loading is set to True, ghost will wait
-    for page_loaded event.
+    for page_loaded event. The action is traced, see `traced()`.
     """
-    @wraps(func)
-    def wrapper(self, *args, **kwargs):
-        expect_loading = kwargs.pop('expect_loading', False)
-        timeout = kwargs.pop('timeout', None)
+    def run(self, expect_loading, timeout, *args, **kwargs):
         if expect_loading:
             self.loaded = False
             func(self, *args, **kwargs)
             return self.wait_for_page_loaded(
                 timeout=timeout)
         return func(self, *args, **kwargs)
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        expect_loading = kwargs.pop('expect_loading', False)
+        timeout = kwargs.pop('timeout', None)
+        if self.tracer is None:
+            return run(self, expect_loading, timeout, *args, **kwargs)
+        with self.tracer.span(self, func.__name__):
+            return run(self, expect_loading, timeout, *args, **kwargs)
+    return wrapper
+
+
+def traced(func):
+    """Decorator that records a span of the session operation when the
+    session has a `Tracer`.
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.tracer is None:
+            return func(self, *args, **kwargs)
+        with self.tracer.span(self, func.__name__):
+            return func(self, *args, **kwargs)
     return wrapper
 
 
+def stitch_tiles(tiles, format=None):
+    """Assembles the tiles returned by `Session.capture_tiles()` or
+    `Session.capture_tiles_to()` into a single QImage, that has to fit in
+    memory. Tile files are only read one at a time.
+
+    :param tiles: An iterable of (x, y, QImage or path) tuples.
+    :param format: The image format, defaults to the first tile one.
+    """
+    tiles = list(tiles)
+    width = height = 0
+    for x, y, tile in tiles:
+        if isinstance(tile, QImage):
+            size = tile.size()
+            tile_format = tile.format()
+        else:
+            reader = QImageReader(tile)
+            size = reader.size()
+            tile_format = reader.imageFormat()
+        if format is None and tile_format != QImage.Format_Invalid:
+            format = tile_format
+        width = max(width, x + size.width())
+        height = max(height, y + size.height())
+
+    if format is None:
+        format = QImage.Format_ARGB32_Premultiplied
+    image = QImage(width, height, format)
+    painter = QPainter(image)
+    for x, y, tile in tiles:
+        if not isinstance(tile, QImage):
+            tile = QImage(tile)
+        painter.drawImage(x, y, tile)
+    painter.end()
+    return image
+
+
+def write_image(image, target, image_format=None, quality=-1,
+                compression=None):
+    """Encodes a QImage to a file or a QIODevice.
+
+    :param image: The QImage to encode.
+    :param target: The file path or the QIODevice.
+    :param image_format: The file format (e.g. 'png', 'jpeg', 'webp'),
+        guessed from the path extension by default.
+    :param quality: The JPEG or WebP quality, from 0 to 100, -1 being the
+        format default.
+    :param compression: An optional PNG compression level, from 0 to 9,
+        that takes precedence over `quality`.
+    """
+    writer = QImageWriter()
+    if isinstance(target, str):
+        writer.setFileName(target)
+    else:
+        writer.setDevice(target)
+    if image_format is not None:
+        writer.setFormat(QByteArray(image_format.lower().encode('ascii')))
+    if compression is not None:
+        # Qt derives the PNG compression level from the quality.
+        quality = 100 - (compression * 91 + 8) // 9
+    writer.setQuality(quality)
+    if not writer.write(image):
+        raise Error('Unable to write image: %s' % writer.errorString())
+
+
+class ImageBuffer(object):
+    """Exposes the pixels of a 32 bits per pixel QImage through the NumPy
+    array interface, without copying them. Arrays created from it keep it,
+    and so the image, alive.
+
+    :param image: The QImage.
+    """
+    def __init__(self, image):
+        if image.depth() != 32:
+            raise Error('Only 32 bits per pixel images can be exposed')
+        self.image = image
+
+    @property
+    def __array_interface__(self):
+        import numpy
+        bits = numpy.frombuffer(self.image.bits(), numpy.uint8)
+        return {
+            'version': 3,
+            'shape': (self.image.height(), self.image.width(), 4),
+            'typestr': '|u1',
+            'strides': (self.image.bytesPerLine(), 4, 1),
+            'data': (bits.ctypes.data, False),
+        }
+
+
+class ImageEncoder(object):
+    """Encodes images on a pool of threads, so that compressing large
+    screenshots doesn't block the Qt event loop and the other sessions.
+    See `write_image()` for the encoding options.
+
+    :param max_workers: The number of encoding threads.
+    """
+    def __init__(self, max_workers=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def encode(self, image, image_format='png', quality=-1,
+               compression=None):
+        """Encodes an image in memory.
+
+        :param image: The QImage to encode.
+        :return: A Future resolved with the encoded bytes.
+        """
+        return self._executor.submit(
+            self._encode, image, image_format, quality, compression)
+
+    def save(self, image, path, image_format=None, quality=-1,
+             compression=None):
+        """Encodes an image to a file.
+
+        :param image: The QImage to encode.
+        :param path: The destination path.
+        :return: A Future resolved with the path once written.
+        """
+        return self._executor.submit(
+            self._save, image, path, image_format, quality, compression)
+
+    def shutdown(self, wait=True):
+        """Stops the encoding threads.
+
+        :param wait: Whether to wait for the pending images.
+        """
+        self._executor.shutdown(wait=wait)
+
+    def _encode(self, image, image_format, quality, compression):
+        data = QByteArray()
+        buffer_ = QBuffer(data)
+        buffer_.open(QIODevice.WriteOnly)
+        write_image(image, buffer_, image_format, quality, compression)
+        buffer_.close()
+        return data.data()
+
+    def _save(self, image, path, image_format, quality, compression):
+        write_image(image, path, image_format, quality, compression)
+        return path
+
+
+class ReplyBody(object):
+    """Accumulates a reply body chunk by chunk.
+
+    Chunks are appended to a growing bytearray which is spilled to a
+    temporary file once it gets bigger than `max_memory` bytes, or once
+    `policy` refuses to reserve memory for it, so that large bodies are
+    neither copied over and over nor kept in memory.
+
+    :param max_memory: The maximum number of bytes kept in memory.
+    :param policy: An optional `ResourcePolicy` accounting for the bytes
+        kept in memory, `reserved` of them are accounted for this body.
+    """
+    def __init__(self, max_memory=16 * 1024 * 1024, policy=None):
+        self.max_memory = max_memory
+        self.policy = policy
+        self.reserved = 0
+        self.size = 0
+        self._buffer = bytearray()
+        self._file = None
+        self._map = None
+
+    def append(self, chunk):
+        """Appends a chunk of bytes to the body.
+
+        :param chunk: A bytes-like object.
+        """
+        if self._file is None and (
+            self.size + len(chunk) > self.max_memory or
+            not self._reserve(len(chunk))
+        ):
+            self._file = tempfile.TemporaryFile(prefix='ghost-')
+            self._file.write(self._buffer)
+            self._buffer = None
+            self.release()
+        if self._file is None:
+            self._buffer.extend(chunk)
+        else:
+            self._file.write(chunk)
+        self.size += len(chunk)
+
+    def view(self):
+        """Returns the body as a memoryview, without copying it. The body
+        can't be appended to while the view is alive.
+        """
+        if self._file is None:
+            return memoryview(self._buffer)
+        if self._map is None:
+            self._file.flush()
+            self._map = mmap.mmap(
+                self._file.fileno(),
+                0,
+                access=mmap.ACCESS_READ,
+            )
+        return memoryview(self._map)
+
+    def release(self):
+        """Gives the memory reserved for this body back to its policy,
+        once the body is spilled to disk or dropped.
+        """
+        if self.policy is not None and self.reserved:
+            self.policy.release(self.reserved)
+        self.reserved = 0
+
+    def _reserve(self, size):
+        if self.policy is None:
+            return True
+        if not self.policy.reserve(size):
+            return False
+        self.reserved += size
+        return True
+
+
+class ResourcePolicy(object):
+    """Tells which reply bodies a session retains in `http_resources` and
+    how much of them is kept in memory. Resources are always recorded,
+    dropped bodies leave them with headers only.
+
+    :param keep_bodies: Set to False to drop bodies, but documents.
+    :param keep_documents: Keeps HTML documents bodies whatever the other
+        options are, so that the page resource still has a content.
+    :param mime_types: An optional regex, only bodies whose Content-Type
+        matches it (or whose URL matches `urls`) are kept.
+    :param urls: An optional regex, only bodies whose URL matches it (or
+        whose Content-Type matches `mime_types`) are kept.
+    :param max_body_memory: The number of bytes of a single body kept in
+        memory before spilling it to disk.
+    :param max_total_memory: An optional number of bytes of bodies kept
+        in memory, downloading or retained, before spilling the next
+        ones to disk. Bytes are reserved as chunks are received, and
+        released by each session along with its resources, so that a
+        policy shared by sessions (e.g. a pool's) bounds them all.
+    """
+    document_types = re.compile(r'^(text/html|application/xhtml\+xml)')
+
+    def __init__(
+        self,
+        keep_bodies=True,
+        keep_documents=True,
+        mime_types=None,
+        urls=None,
+        max_body_memory=16 * 1024 * 1024,
+        max_total_memory=None,
+    ):
+        self.keep_bodies = keep_bodies
+        self.keep_documents = keep_documents
+        self.mime_types = re.compile(mime_types) if mime_types else None
+        self.urls = re.compile(urls) if urls else None
+        self.max_body_memory = max_body_memory
+        self.max_total_memory = max_total_memory
+        self.memory_used = 0
+
+    def keeps_body(self, reply):
+        """Checks if the body of given reply has to be retained.
+
+        :param reply: The QNetworkReply object.
+        """
+        if getattr(reply, 'keep_body', False):
+            return True
+        content_type = reply.header(QNetworkRequest.ContentTypeHeader) or ''
+        if self.keep_documents and self.document_types.match(content_type):
+            return True
+        if not self.keep_bodies:
+            return False
+        if self.mime_types is None and self.urls is None:
+            return True
+        return bool(
+            (self.mime_types and self.mime_types.search(content_type)) or
+            (self.urls and self.urls.search(reply.url().toString()))
+        )
+
+    def create_body(self, reply):
+        """Returns a `ReplyBody` for given reply, or None if its body
+        doesn't have to be retained.
+
+        :param reply: The QNetworkReply object.
+        """
+        if not self.keeps_body(reply):
+            return None
+        return ReplyBody(max_memory=self.max_body_memory, policy=self)
+
+    def reserve(self, size):
+        """Reserves memory for a body chunk, returns False if it would
+        exceed `max_total_memory`.
+
+        :param size: The number of bytes.
+        """
+        if (
+            self.max_total_memory is not None and
+            self.memory_used + size > self.max_total_memory
+        ):
+            return False
+        self.memory_used += size
+        return True
+
+    def release(self, size):
+        """Releases memory reserved by `reserve()`.
+
+        :param size: The number of bytes.
+        """
+        self.memory_used -= size
+
+
 class HttpResource(object):
     """Represents an HTTP resource.
+
+    Timings are epoch times in seconds: `started` when the request was
+    sent, `first_byte` when the response headers were received and
+    `finished` when the reply ended. `bytes_received` counts the body
+    bytes, retained or not, `blocked` tells if the request was blocked
+    before being sent and `type` is its guessed `resource_type()`.
     """
     def __init__(self, session, reply, content):
         self.session = session
         self.url = reply.url().toString()
-        self.content = bytes(content.data())
+        self._body = content
+        self._content = None
         self.http_status = reply.attribute(
             QNetworkRequest.HttpStatusCodeAttribute)
+        self.from_cache = bool(reply.attribute(
+            QNetworkRequest.SourceIsFromCacheAttribute))
+        self.started = getattr(reply, 'started', None)
+        self.first_byte = getattr(reply, 'first_byte', None)
+        self.finished = time.time()
+        self.bytes_received = getattr(reply, 'bytes_received', 0)
+        self.blocked = getattr(reply, 'blocked', False)
+        self.type = resource_type(reply.request())
         self.session.logger.info(
-            "Resource loaded: %s %s", self.url, self.http_status
+            "Resource %s: %s %s%s",
+            "blocked" if self.blocked else "loaded",
+            self.url,
+            self.http_status,
+            " (cache)" if self.from_cache else "",
         )
         self.headers = {}
         for header in reply.rawHeaderList():
@@ -210,12 +590,993 @@ class HttpResource(object):
                 )
         self._reply = reply
 
+    @property
+    def body(self):
+        """Returns the body as a memoryview, without copying it, or None
+        if it hasn't been retained.
+        """
+        if self._content is not None:
+            return memoryview(self._content)
+        if self._body is None:
+            return None
+        return self._body.view()
+
+    @property
+    def content(self):
+        """Returns the body as bytes, built on first access, or None if it
+        hasn't been retained.
+        """
+        if self._content is None and self._body is not None:
+            self._content = self._body.view().tobytes()
+            self._body = None
+        return self._content
+
+    @property
+    def wait(self):
+        """Returns the time in seconds to the first byte, or None."""
+        if self.started is None or self.first_byte is None:
+            return None
+        return self.first_byte - self.started
+
+    @property
+    def duration(self):
+        """Returns the request duration in seconds, or None."""
+        if self.started is None:
+            return None
+        return self.finished - self.started
+
+
+class Waterfall(object):
+    """Timing summary of the requests made while loading a page, to tell
+    which resources and hosts slow it down.
+
+    :param resources: The `HttpResource` list, blocked ones included.
+    """
+    def __init__(self, resources):
+        self.resources = sorted(
+            (r for r in resources if r.started is not None),
+            key=lambda r: r.started,
+        )
+        if self.resources:
+            self.started = self.resources[0].started
+            self.finished = max(r.finished for r in self.resources)
+        else:
+            self.started = self.finished = None
+
+    @property
+    def duration(self):
+        """Returns the time in seconds from the first request sent to the
+        last one ended.
+        """
+        if self.started is None:
+            return 0
+        return self.finished - self.started
+
+    def slowest(self, count=10):
+        """Returns the `count` longest requests.
+
+        :param count: The number of resources to return.
+        """
+        return sorted(
+            self.resources,
+            key=lambda r: r.duration,
+            reverse=True,
+        )[:count]
+
+    def by_host(self):
+        """Returns a dict of the number of requests, blocked requests,
+        bytes received and cumulated request time, in seconds, by host.
+        """
+        hosts = {}
+        for resource in self.resources:
+            host = hosts.setdefault(QUrl(resource.url).host(), {
+                'requests': 0,
+                'blocked': 0,
+                'bytes': 0,
+                'time': 0,
+            })
+            host['requests'] += 1
+            host['blocked'] += int(resource.blocked)
+            host['bytes'] += resource.bytes_received
+            host['time'] += resource.duration
+        return hosts
+
+    def __str__(self):
+        def ms(seconds):
+            return '-' if seconds is None else '%d' % (seconds * 1000)
+
+        lines = ['%7s %7s %7s %9s %6s  %s' % (
+            'start', 'wait', 'total', 'bytes', 'status', 'url')]
+        for resource in self.resources:
+            if resource.blocked:
+                status = 'block'
+            elif resource.from_cache:
+                status = 'cache'
+            else:
+                status = resource.http_status
+            lines.append('%7s %7s %7s %9d %6s  %s' % (
+                ms(resource.started - self.started),
+                ms(resource.wait),
+                ms(resource.duration),
+                resource.bytes_received,
+                status,
+                resource.url,
+            ))
+        return '\n'.join(lines)
+
+
+def replyMetaDataChanged(reply):
+    if getattr(reply, 'first_byte', None) is None:
+        reply.first_byte = time.time()
+
+
+def replyReadyRead(reply, policy=None):
+    if not hasattr(reply, 'body'):
+        reply.body = (
+            ReplyBody() if policy is None else policy.create_body(reply)
+        )
+
+    available = reply.bytesAvailable()
+    reply.bytes_received = getattr(reply, 'bytes_received', 0) + available
+    if reply.body is not None:
+        reply.body.append(reply.peek(available).data())
+
+
+class DiskCache(QNetworkDiskCache):
+    """QNetworkDiskCache that evicts least recently used entries first.
+
+    Reads are recorded in memory by URL. `expire()` merges them into an
+    index of the cache files, kept in the cache directory so that caches
+    sharing it see each other's reads, then removes the files neither
+    read nor written for the longest time.
+    """
+    index_name = 'ghost-lru.json'
+
+    def __init__(self, *args, **kwargs):
+        super(DiskCache, self).__init__(*args, **kwargs)
+        self._accessed = {}
+        self._size = None
+
+    def data(self, url):
+        device = super(DiskCache, self).data(url)
+        if device is not None:
+            self._accessed[self._clean(url)] = time.time()
+        return device
+
+    def insert(self, device):
+        size = device.size()
+        super(DiskCache, self).insert(device)
+        if self._size is not None:
+            self._size += size
+
+    def clear(self):
+        super(DiskCache, self).clear()
+        self._size = None
+
+    def _clean(self, url):
+        return url.adjusted(
+            QUrl.RemovePassword | QUrl.RemoveFragment).toString()
+
+    def expire(self):
+        if self._size is not None and self._size < self.maximumCacheSize():
+            return self._size
+
+        directory = self.cacheDirectory()
+        index_path = os.path.join(directory, self.index_name)
+        index = self._load_index(index_path)
+        entries = {}
+        size = 0
+        for root, dirs, names in os.walk(directory):
+            if os.path.basename(root) == 'prepared':
+                continue
+            for name in names:
+                if root == directory and name.startswith(self.index_name):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                key = os.path.relpath(path, directory)
+                entry = index.get(key)
+                if entry is None or entry['mtime'] != stat.st_mtime:
+                    # Only new or rewritten files get their URL read.
+                    entry = {
+                        'url': self._clean(self.fileMetaData(path).url()),
+                        'mtime': stat.st_mtime,
+                        'accessed': stat.st_mtime,
+                    }
+                entry['accessed'] = max(
+                    entry['accessed'],
+                    self._accessed.get(entry['url'], 0),
+                )
+                entry['size'] = stat.st_size
+                entries[key] = entry
+                size += stat.st_size
+        self._accessed = {}
+
+        if size > self.maximumCacheSize():
+            target = self.maximumCacheSize() * 9 // 10
+            for key in sorted(entries, key=lambda k: entries[k]['accessed']):
+                if size <= target:
+                    break
+                try:
+                    os.remove(os.path.join(directory, key))
+                except OSError:
+                    continue
+                size -= entries.pop(key)['size']
+        self._save_index(index_path, entries)
+        self._size = size
+        return size
+
+    def _load_index(self, path):
+        try:
+            with codecs.open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_index(self, path, entries):
+        """Writes the index, atomically as other caches may read it."""
+        temporary = '%s.%s' % (path, os.getpid())
+        try:
+            with codecs.open(temporary, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(temporary, path)
+        except (IOError, OSError):
+            logger.warning('Could not write cache index %s', path)
+
+
+class HttpCache(object):
+    """An on-disk HTTP cache that can be shared by sessions, and by
+    processes, using the same directory. Freshness and revalidation follow
+    the HTTP caching headers, least recently used entries are evicted once
+    `max_size` is reached.
+
+    :param directory: The cache directory.
+    :param max_size: The maximum cache size in bytes.
+    """
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def create(self):
+        """Returns a new `DiskCache` for a QNetworkAccessManager."""
+        cache = DiskCache()
+        cache.setCacheDirectory(self.directory)
+        cache.setMaximumCacheSize(self.max_size)
+        return cache
+
+    def record(self, resource):
+        """Accounts for a loaded `HttpResource`."""
+        if resource.from_cache:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+
+class BufferedReply(QNetworkReply):
+    """Base class of the QNetworkReply implementations serving a body from
+    an internal buffer.
+
+    :param manager: The `NetworkAccessManager` creating the reply.
+    :param operation: The QNetworkAccessManager operation.
+    :param request: The QNetworkRequest.
+    """
+    def __init__(self, manager, operation, request):
+        super(BufferedReply, self).__init__(manager)
+        self._buffer = bytearray()
+        self.setRequest(request)
+        self.setUrl(request.url())
+        self.setOperation(operation)
+        self.open(QIODevice.ReadOnly | QIODevice.Unbuffered)
+
+    def abort(self):
+        if not self.isFinished():
+            self.setError(
+                QNetworkReply.OperationCanceledError,
+                'Operation canceled',
+            )
+            self._finish()
+
+    def isSequential(self):
+        return True
+
+    def bytesAvailable(self):
+        return (
+            len(self._buffer) +
+            super(BufferedReply, self).bytesAvailable()
+        )
+
+    def readData(self, maxlen):
+        data = bytes(self._buffer[:maxlen])
+        del self._buffer[:maxlen]
+        return data
+
+    def _finish(self):
+        self.setFinished(True)
+        self.finished.emit()
+
+
+class DeferredReply(BufferedReply):
+    """A QNetworkReply whose request is only sent once `start()` gets
+    called. It forwards everything the underlying reply receives.
+
+    :param manager: The `NetworkAccessManager` that sends the request.
+    :param operation: The QNetworkAccessManager operation.
+    :param request: The QNetworkRequest to send.
+    :param data: The outgoing data device.
+    """
+    forwarded_attributes = (
+        QNetworkRequest.HttpStatusCodeAttribute,
+        QNetworkRequest.HttpReasonPhraseAttribute,
+        QNetworkRequest.RedirectionTargetAttribute,
+        QNetworkRequest.SourceIsFromCacheAttribute,
+        QNetworkRequest.ConnectionEncryptedAttribute,
+    )
+
+    def __init__(self, manager, operation, request, data):
+        super(DeferredReply, self).__init__(manager, operation, request)
+        self._manager = manager
+        self._data = data
+        self._reply = None
+
+    def start(self):
+        """Sends the request.
+
+        :return: The underlying QNetworkReply.
+        """
+        reply = QNetworkAccessManager.createRequest(
+            self._manager,
+            self.operation(),
+            self.request(),
+            self._data,
+        )
+        reply.setParent(self)
+        # Timings start once the request is actually sent.
+        self.started = time.time()
+        reply.metaDataChanged.connect(self._forward_meta_data)
+        reply.readyRead.connect(self._forward_data)
+        reply.downloadProgress.connect(self.downloadProgress.emit)
+        reply.uploadProgress.connect(self.uploadProgress.emit)
+        reply.sslErrors.connect(self.sslErrors.emit)
+        reply.finished.connect(self._forward_finished)
+        self._reply = reply
+        return reply
+
+    def abort(self):
+        if self._reply is not None:
+            self._reply.abort()
+        else:
+            super(DeferredReply, self).abort()
+
+    def ignoreSslErrors(self, *args):
+        if self._reply is not None:
+            self._reply.ignoreSslErrors(*args)
+
+    def _forward_meta_data(self):
+        reply = self._reply
+        self.setUrl(reply.url())
+        for header in reply.rawHeaderList():
+            self.setRawHeader(header, reply.rawHeader(header))
+        for attribute in self.forwarded_attributes:
+            self.setAttribute(attribute, reply.attribute(attribute))
+        self.metaDataChanged.emit()
+
+    def _forward_data(self):
+        self._buffer.extend(bytes(self._reply.readAll()))
+        self.readyRead.emit()
+
+    def _forward_finished(self):
+        if self._reply.error() != QNetworkReply.NoError:
+            self.setError(self._reply.error(), self._reply.errorString())
+        self._finish()
+
+
+class CannedResponse(object):
+    """A response served by `NetworkAccessManager` without any network
+    access.
+
+    :param body: The response body as bytes.
+    :param status: The HTTP status code.
+    :param headers: An optional dict of response headers.
+    :param reason: An optional HTTP reason phrase.
+    :param error: An optional QNetworkReply error code, the response then
+        fails with it instead.
+    """
+    def __init__(self, body=b'', status=200, headers=None, reason=None,
+                 error=None):
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+        self.reason = reason
+        self.error = error
+
+
+class CannedReply(BufferedReply):
+    """A QNetworkReply serving a `CannedResponse`.
+
+    :param manager: The `NetworkAccessManager` creating the reply.
+    :param operation: The QNetworkAccessManager operation.
+    :param request: The QNetworkRequest.
+    :param response: The `CannedResponse` to serve.
+    """
+    def __init__(self, manager, operation, request, response):
+        super(CannedReply, self).__init__(manager, operation, request)
+        self.response = response
+        if response.error is not None:
+            self.setError(response.error, 'Request intercepted')
+        else:
+            self.setAttribute(
+                QNetworkRequest.HttpStatusCodeAttribute,
+                response.status,
+            )
+            if response.reason is not None:
+                self.setAttribute(
+                    QNetworkRequest.HttpReasonPhraseAttribute,
+                    response.reason,
+                )
+            for name, value in response.headers.items():
+                self.setRawHeader(
+                    QByteArray(name.encode('latin-1')),
+                    QByteArray(value.encode('latin-1')),
+                )
+            self.setHeader(
+                QNetworkRequest.ContentLengthHeader,
+                len(response.body),
+            )
+            location = response.headers.get('Location')
+            if location is not None and 300 <= response.status < 400:
+                self.setAttribute(
+                    QNetworkRequest.RedirectionTargetAttribute,
+                    QUrl(location),
+                )
+            self._buffer.extend(response.body)
+        # Signals are emitted once WebKit got the reply.
+        QTimer.singleShot(0, self._respond)
+
+    def _respond(self):
+        if self.isFinished():
+            return
+        self.metaDataChanged.emit()
+        if self._buffer:
+            self.downloadProgress.emit(len(self._buffer), len(self._buffer))
+            self.readyRead.emit()
+        self._finish()
+
+
+class RequestScheduler(object):
+    """Throttles the requests sent by `NetworkAccessManager`. Requests
+    that can't be sent right away are answered with a `DeferredReply`, so
+    that request creation never blocks the event loop.
+
+    A scheduler can be shared by several sessions for the limits to apply
+    to all of them.
+
+    :param max_per_host: An optional maximum number of concurrent requests
+        per host.
+    :param max_rate: An optional maximum number of requests started per
+        second per host.
+    """
+    def __init__(self, max_per_host=None, max_rate=None):
+        self.max_per_host = max_per_host
+        self.max_rate = max_rate
+        self._running = defaultdict(int)
+        self._started_at = {}
+        self._queues = defaultdict(deque)
+        self._scheduled = set()
+
+    def create_request(self, manager, operation, request, data):
+        """Returns a reply for given request, either already sent or
+        deferred.
+        """
+        host = request.url().host()
+        if (
+            not self._queues[host] and
+            self._has_slot(host) and
+            self._delay(host) == 0
+        ):
+            reply = QNetworkAccessManager.createRequest(
+                manager,
+                operation,
+                request,
+                data,
+            )
+            self._started(host, reply)
+            return reply
+
+        reply = DeferredReply(manager, operation, request, data)
+        self._queues[host].append(reply)
+        self._schedule(host)
+        return reply
+
+    def _has_slot(self, host):
+        return (
+            self.max_per_host is None or
+            self._running[host] < self.max_per_host
+        )
+
+    def _delay(self, host):
+        """Returns the delay in millisecond before the next request to
+        host is allowed by `max_rate`.
+        """
+        if not self.max_rate or host not in self._started_at:
+            return 0
+        elapsed = time.time() - self._started_at[host]
+        return max(0, int((1.0 / self.max_rate - elapsed) * 1000))
+
+    def _started(self, host, reply):
+        self._running[host] += 1
+        self._started_at[host] = time.time()
+        reply.finished.connect(lambda host=host: self._finished(host))
+
+    def _finished(self, host):
+        self._running[host] -= 1
+        self._schedule(host)
+
+    def _schedule(self, host):
+        queue = self._queues[host]
+        while queue and queue[0].isFinished():
+            # Aborted before being sent.
+            queue.popleft()
+        if not queue or host in self._scheduled or not self._has_slot(host):
+            return
+        self._scheduled.add(host)
+        QTimer.singleShot(
+            self._delay(host),
+            lambda host=host: self._start_next(host),
+        )
+
+    def _start_next(self, host):
+        self._scheduled.discard(host)
+        queue = self._queues[host]
+        while queue and self._has_slot(host):
+            reply = queue.popleft()
+            if reply.isFinished():
+                continue
+            self._started(host, reply.start())
+            if self.max_rate:
+                break
+        self._schedule(host)
+
+
+class Blocklist(object):
+    """Request interceptor blocking URLs matching adblock-style rules.
+
+    Supported rules are `||domain^` domain anchors, looked up in a domain
+    trie, and URL patterns with `|` anchors, `*` wildcards and `^`
+    separators, compiled into a single regex; `||domain` without `^` is
+    a prefix pattern. `@@` rules are exceptions. Comments and element
+    hiding rules are ignored. Rules with `$options` can't be applied as
+    written and are skipped, their count is kept in `skipped`. The number
+    of hits of each rule is counted in `hits`.
+
+    :param rules: An iterable of rules.
+    """
+    domain_rule = re.compile(r'^\|\|([a-z0-9.-]+)\^$')
+
+    def __init__(self, rules=()):
+        self.hits = defaultdict(int)
+        self.skipped = 0
+        # Rules as [patterns, domain trie, compiled patterns].
+        self._blocks = [[], {}, None]
+        self._exceptions = [[], {}, None]
+        for rule in rules:
+            self.add(rule)
+        self._compile()
+
+    @classmethod
+    def from_file(cls, path, encoding='utf-8'):
+        """Builds a blocklist from a filter list file.
+
+        :param path: The path of the file.
+        :param encoding: The file's encoding.
+        """
+        with codecs.open(path, encoding=encoding) as f:
+            return cls(f)
+
+    def add(self, rule):
+        """Adds a rule, call `compile()` once done adding rules.
+
+        :param rule: The rule.
+        """
+        rule = rule.strip()
+        if not rule or rule[0] in '![' or '##' in rule or '#@#' in rule:
+            return
+        patterns, trie, _ = self._blocks
+        if rule.startswith('@@'):
+            patterns, trie, _ = self._exceptions
+            rule = rule[2:]
+        if '$' in rule:
+            self.skipped += 1
+            return
+        pattern = rule.lower()
+        if not pattern:
+            return
+
+        match = self.domain_rule.match(pattern)
+        if match:
+            node = trie
+            for label in reversed(match.group(1).split('.')):
+                node = node.setdefault(label, {})
+            node[''] = rule
+        else:
+            patterns.append((rule, pattern))
+
+    def compile(self):
+        """Compiles the URL patterns rules."""
+        self._compile()
+
+    def __call__(self, operation, request):
+        url = request.url()
+        host = url.host().lower()
+        url = url.toString().lower()
+        rule = self._match(self._blocks, host, url)
+        if rule is None or self._match(self._exceptions, host, url):
+            return None
+        self.hits[rule] += 1
+        return False
+
+    def _compile(self):
+        for rules in (self._blocks, self._exceptions):
+            groups = [
+                '(?P<r%d>%s)' % (index, self._translate(pattern))
+                for index, (_, pattern) in enumerate(rules[0])
+            ]
+            rules[2] = re.compile('|'.join(groups)) if groups else None
+
+    def _translate(self, pattern):
+        regex = ''
+        if pattern.startswith('||'):
+            regex = r'^[a-z][a-z0-9+.-]*://([^/?#]*\.)?'
+            pattern = pattern[2:]
+        elif pattern.startswith('|'):
+            regex = '^'
+            pattern = pattern[1:]
+        end = ''
+        if pattern.endswith('|'):
+            end = '$'
+            pattern = pattern[:-1]
+        for char in pattern:
+            if char == '*':
+                regex += '.*'
+            elif char == '^':
+                regex += r'(?:[^a-z0-9_.%-]|$)'
+            else:
+                regex += re.escape(char)
+        return regex + end
+
+    def _match(self, rules, host, url):
+        """Returns the first rule matching host or url, if any."""
+        patterns, trie, regex = rules
+        node = trie
+        for label in reversed(host.split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            if '' in node:
+                return node['']
+        if regex is not None:
+            match = regex.search(url)
+            if match:
+                return patterns[int(match.lastgroup[1:])][0]
+        return None
+
+
+resource_extensions = {
+    'stylesheet': ('css',),
+    'script': ('js', 'mjs'),
+    'image': ('png', 'jpg', 'jpeg', 'gif', 'webp', 'svg', 'ico', 'bmp'),
+    'font': ('woff', 'woff2', 'ttf', 'otf', 'eot'),
+    'media': ('mp4', 'webm', 'ogg', 'ogv', 'oga', 'mp3', 'wav', 'm4a',
+              'mov', 'flac', 'm3u8', 'mpd'),
+}
+resource_types_by_extension = dict(
+    (extension, type_)
+    for type_, extensions in resource_extensions.items()
+    for extension in extensions
+)
+
+
+def resource_type(request):
+    """Guesses the type of resource requested by WebKit from the Accept
+    header it sets, the requesting frame and the URL extension.
+
+    :param request: The QNetworkRequest.
+    :return: One of 'document', 'subframe', 'stylesheet', 'script',
+        'image', 'font', 'media', 'xhr' or 'other'.
+    """
+    accept = request.rawHeader(QByteArray(b'Accept')).data().decode(
+        'latin-1')
+    if accept.startswith('text/html') or 'application/xhtml+xml' in accept:
+        frame = request.originatingObject()
+        if frame is not None and frame.parentFrame() is not None:
+            return 'subframe'
+        return 'document'
+    if accept.startswith('text/css'):
+        return 'stylesheet'
+    if accept.startswith('image/'):
+        return 'image'
+
+    path = request.url().path()
+    extension = path.rsplit('.', 1)[-1].lower() if '.' in path else ''
+    if extension in resource_types_by_extension:
+        return resource_types_by_extension[extension]
+    if accept and not extension:
+        return 'xhr'
+    return 'other'
+
+
+class LoadingProfile(object):
+    """Request interceptor aborting, before anything is fetched, the
+    requests for the resource types a session doesn't need. See
+    `resource_type()` for the known types.
+
+    :param blocked_types: The resource types to block.
+    """
+    profiles = {
+        'full': (),
+        'no-media': ('image', 'media', 'font'),
+        'text-only': ('image', 'media', 'font', 'stylesheet', 'subframe'),
+    }
+
+    def __init__(self, blocked_types=()):
+        self.blocked_types = frozenset(blocked_types)
+        self.blocked = defaultdict(int)
+
+    @classmethod
+    def named(cls, name):
+        """Returns a new profile by name: 'full', 'no-media' or
+        'text-only'.
+        """
+        try:
+            return cls(cls.profiles[name])
+        except KeyError:
+            raise Error('Unknown loading profile %s' % name)
+
+    def __call__(self, operation, request):
+        if not self.blocked_types:
+            return None
+        type_ = resource_type(request)
+        if type_ in self.blocked_types:
+            self.blocked[type_] += 1
+            return False
+        return None
+
+
+operation_methods = {
+    QNetworkAccessManager.HeadOperation: 'HEAD',
+    QNetworkAccessManager.GetOperation: 'GET',
+    QNetworkAccessManager.PutOperation: 'PUT',
+    QNetworkAccessManager.PostOperation: 'POST',
+    QNetworkAccessManager.DeleteOperation: 'DELETE',
+}
+
+
+def request_method(operation, request):
+    """Returns the HTTP method of a QNetworkAccessManager operation."""
+    if operation == QNetworkAccessManager.CustomOperation:
+        return QByteArray(request.attribute(
+            QNetworkRequest.CustomVerbAttribute)).data().decode('latin-1')
+    return operation_methods[operation]
+
+
+def request_body(data):
+    """Returns the body of an outgoing request without consuming it.
+
+    :param data: The QIODevice given to `createRequest()`, if any.
+    """
+    if data is None:
+        return b''
+    return data.peek(max(data.size(), data.bytesAvailable())).data()
+
+
+def raw_headers(message):
+    """Returns the raw headers of a QNetworkRequest or QNetworkReply as a
+    list of (name, value) tuples.
+    """
+    return [
+        (
+            name.data().decode('latin-1'),
+            message.rawHeader(name).data().decode('latin-1'),
+        )
+        for name in message.rawHeaderList()
+    ]
+
+
+class HarArchive(object):
+    """Records the requests of a session and their responses to a HAR
+    file, or replays them from it without any network access.
+
+    In record mode, reply bodies are retained whatever the session
+    `ResourcePolicy`; responses whose body is missing anyway are left out
+    with a warning, rather than replayed empty.
+
+    In replay mode, requests are matched against the recorded ones by the
+    properties listed in `match`. Identical requests get the recorded
+    responses in order, the last one being served again once all have
+    been; requests that weren't recorded fail, they are counted in
+    `misses` and listed in `missed` as (method, url) tuples.
+
+    :param path: The HAR file path.
+    :param mode: 'record' or 'replay'.
+    :param match: The request properties identifying a recorded response,
+        any of 'method', 'url' and 'body' (compared by SHA-1 hash).
+    """
+    # Bodies are stored decoded, with their length set on replay.
+    dropped_headers = frozenset([
+        'content-encoding',
+        'content-length',
+        'transfer-encoding',
+    ])
+
+    def __init__(self, path, mode='replay', match=('method', 'url', 'body')):
+        if mode not in ('record', 'replay'):
+            raise Error('Unknown HAR archive mode %s' % mode)
+        self.path = path
+        self.mode = mode
+        self.match = frozenset(match)
+        self.entries = []
+        self.misses = 0
+        self.missed = []
+        self._responses = {}
+        if mode == 'replay':
+            self.load()
+
+    def load(self):
+        """Loads the entries of the HAR file."""
+        with codecs.open(self.path, encoding='utf-8') as f:
+            self.entries = json.load(f)['log']['entries']
+        self._responses = defaultdict(deque)
+        for entry in self.entries:
+            request = entry['request']
+            key = self._key(
+                request['method'],
+                request['url'],
+                self._decode(request.get('postData', {})),
+            )
+            self._responses[key].append(entry['response'])
+
+    def save(self):
+        """Writes the recorded entries to the HAR file."""
+        har = {
+            'log': {
+                'version': '1.2',
+                'creator': {'name': 'Ghost.py', 'version': '2.0.0-dev'},
+                'pages': [],
+                'entries': self.entries,
+            },
+        }
+        with codecs.open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(har, f, indent=1)
+
+    def record(self, reply, resource):
+        """Records a finished request.
 
-def replyReadyRead(reply):
-    if not hasattr(reply, 'data'):
-        reply.data = ''
+        :param reply: The QNetworkReply object.
+        :param resource: Its `HttpResource`.
+        """
+        content = resource.body
+        if content is None and resource.bytes_received:
+            logger.warning(
+                'Not recording %s, its body has been dropped', resource.url)
+            return
+        content = b'' if content is None else content.tobytes()
+
+        request = reply.request()
+        body = getattr(reply, 'request_body', b'')
+        content_type = request.header(QNetworkRequest.ContentTypeHeader)
+        entry_request = {
+            'method': getattr(reply, 'request_method', 'GET'),
+            'url': resource.url,
+            'httpVersion': 'HTTP/1.1',
+            'headers': self._headers(raw_headers(request)),
+            'queryString': [],
+            'cookies': [],
+            'headersSize': -1,
+            'bodySize': len(body),
+        }
+        if body:
+            entry_request['postData'] = self._encode(
+                body, content_type or 'application/octet-stream')
+
+        headers = raw_headers(reply)
+        redirect = reply.attribute(QNetworkRequest.RedirectionTargetAttribute)
+        started = resource.started or resource.finished
+        wait = resource.wait or 0
+        duration = resource.duration or 0
+        self.entries.append({
+            'startedDateTime': datetime.fromtimestamp(
+                started, timezone.utc).isoformat(),
+            'time': duration * 1000,
+            'request': entry_request,
+            'response': {
+                'status': resource.http_status,
+                'statusText': reply.attribute(
+                    QNetworkRequest.HttpReasonPhraseAttribute) or '',
+                'httpVersion': 'HTTP/1.1',
+                'headers': self._headers(headers),
+                'cookies': [],
+                'content': self._encode(
+                    content,
+                    reply.header(QNetworkRequest.ContentTypeHeader) or '',
+                ),
+                'redirectURL': redirect.toString() if redirect else '',
+                'headersSize': -1,
+                'bodySize': len(content),
+            },
+            'cache': {},
+            'timings': {
+                'send': 0,
+                'wait': wait * 1000,
+                'receive': (duration - wait) * 1000,
+            },
+        })
+
+    def response_for(self, method, url, body):
+        """Returns a `CannedResponse` replaying the recorded response of
+        given request.
+
+        :param method: The HTTP method.
+        :param url: The request URL.
+        :param body: The request body as bytes.
+        """
+        responses = self._responses.get(self._key(method, url, body))
+        if not responses:
+            self.misses += 1
+            self.missed.append((method, url))
+            logger.warning('No recorded response for %s %s', method, url)
+            return CannedResponse(error=QNetworkReply.ContentNotFoundError)
+        response = responses[0]
+        if len(responses) > 1:
+            responses.popleft()
+
+        headers = {}
+        for header in response['headers']:
+            name = header['name']
+            if name.lower() in self.dropped_headers:
+                continue
+            if name in headers:
+                separator = '\n' if name.lower() == 'set-cookie' else ', '
+                headers[name] += separator + header['value']
+            else:
+                headers[name] = header['value']
+        return CannedResponse(
+            body=self._decode(response['content']),
+            status=response['status'],
+            headers=headers,
+            reason=response.get('statusText') or None,
+        )
 
-    reply.data += reply.peek(reply.bytesAvailable())
+    def _key(self, method, url, body):
+        key = []
+        if 'method' in self.match:
+            key.append(method.upper())
+        if 'url' in self.match:
+            key.append(url)
+        if 'body' in self.match:
+            key.append(hashlib.sha1(body).hexdigest())
+        return tuple(key)
+
+    def _headers(self, headers):
+        return [{'name': name, 'value': value} for name, value in headers]
+
+    def _encode(self, data, mime_type):
+        content = {'size': len(data), 'mimeType': mime_type}
+        try:
+            content['text'] = data.decode('utf-8')
+        except UnicodeDecodeError:
+            content['text'] = base64.b64encode(data).decode('ascii')
+            content['encoding'] = 'base64'
+        return content
+
+    def _decode(self, content):
+        text = content.get('text', '')
+        if content.get('encoding') == 'base64':
+            return base64.b64decode(text)
+        return text.encode('utf-8')
 
 
 class NetworkAccessManager(QNetworkAccessManager):
@@ -223,26 +1584,419 @@ class NetworkAccessManager(QNetworkAccessManager):
 
     :param exclude_regex: A regex use to determine wich url exclude
         when sending a request
+    :param scheduler: An optional `RequestScheduler` that throttles
+        requests.
+    :param resource_policy: An optional `ResourcePolicy` that tells which
+        bodies to buffer.
+    :param interceptors: An optional list of request interceptors, see
+        `intercept()`.
+    :param archive: An optional `HarArchive` to record requests to, or to
+        replay them from.
+    :param metrics: An optional `Metrics` registry.
     """
-    def __init__(self, exclude_regex=None, *args, **kwargs):
+    def __init__(
+        self,
+        exclude_regex=None,
+        scheduler=None,
+        resource_policy=None,
+        interceptors=None,
+        archive=None,
+        metrics=None,
+        *args,
+        **kwargs
+    ):
         self._regex = re.compile(exclude_regex) if exclude_regex else None
+        self.scheduler = scheduler
+        self.resource_policy = resource_policy
+        self.interceptors = list(interceptors or [])
+        self.archive = archive
+        self.metrics = metrics
+        self.in_flight = 0
         super(NetworkAccessManager, self).__init__(*args, **kwargs)
 
+    def intercept(self, operation, request):
+        """Runs the request through the interceptors, in order.
+
+        An interceptor is a callable taking the operation and the
+        QNetworkRequest, that it may modify in place. It returns None to
+        let the request go on, a new QNetworkRequest to rewrite it, False
+        to block it, or a `CannedResponse` to answer it.
+
+        :return: A tuple of the request and the response to serve, if any.
+        """
+        if self._regex and self._regex.search(request.url().toString()):
+            return request, CannedResponse(
+                error=QNetworkReply.ContentAccessDenied)
+        for interceptor in self.interceptors:
+            result = interceptor(operation, request)
+            if result is None:
+                continue
+            if result is False:
+                return request, CannedResponse(
+                    error=QNetworkReply.ContentAccessDenied)
+            if isinstance(result, QNetworkRequest):
+                request = result
+                continue
+            return request, result
+        return request, None
+
     def createRequest(self, operation, request, data):
-        if self._regex and self._regex.findall(str(request.url().toString())):
-            return QNetworkAccessManager.createRequest(
-                self, QNetworkAccessManager.GetOperation,
-                QNetworkRequest(QUrl()))
-        reply = QNetworkAccessManager.createRequest(
-            self,
-            operation,
-            request,
-            data
-        )
-        reply.readyRead.connect(lambda reply=reply: replyReadyRead(reply))
-        time.sleep(0.001)
+        request, response = self.intercept(operation, request)
+        blocked = response is not None and response.error is not None
+        replay_miss = False
+        if self.archive is not None:
+            method = request_method(operation, request)
+            body = request_body(data)
+            if response is None and self.archive.mode == 'replay':
+                response = self.archive.response_for(
+                    method,
+                    request.url().toString(),
+                    body,
+                )
+                replay_miss = response.error is not None
+        if response is not None:
+            reply = CannedReply(self, operation, request, response)
+        elif self.scheduler is not None:
+            reply = self.scheduler.create_request(
+                self,
+                operation,
+                request,
+                data,
+            )
+        else:
+            reply = QNetworkAccessManager.createRequest(
+                self,
+                operation,
+                request,
+                data
+            )
+        if self.archive is not None and self.archive.mode == 'record':
+            reply.request_method = method
+            reply.request_body = body
+            # The archive needs the bodies whatever the resource policy.
+            reply.keep_body = True
+        reply.started = time.time()
+        reply.first_byte = None
+        reply.bytes_received = 0
+        reply.blocked = blocked
+        reply.replay_miss = replay_miss
+        if self.metrics is not None:
+            self.metrics.increment('requests_total', method=(
+                request_method(operation, request)
+                if operation in operation_methods else 'CUSTOM'))
+            self.metrics.add('requests_in_flight', 1)
+        reply.metaDataChanged.connect(
+            lambda reply=reply: replyMetaDataChanged(reply))
+        reply.readyRead.connect(
+            lambda reply=reply: replyReadyRead(reply, self.resource_policy))
+        self.in_flight += 1
+        reply.finished.connect(self._reply_finished)
         return reply
 
+    def _reply_finished(self):
+        self.in_flight -= 1
+
+
+class Watcher(object):
+    """Resolves a Future once a session condition is met. The condition
+    is checked each time the session gets woken up by a Qt signal and,
+    when polling, every `wait_poll_interval` seconds.
+
+    :param session: The `Session` to watch.
+    :param condition: A callable that returns the condition.
+    :param result: A callable that returns the future result.
+    :param timeout_message: The exception message on timeout.
+    :param timeout: The timeout in second.
+    :param poll: Whether to check the condition periodically.
+    """
+    def __init__(
+        self,
+        session,
+        condition,
+        result,
+        timeout_message,
+        timeout,
+        poll=True,
+    ):
+        self.session = session
+        self.condition = condition
+        self.result = result
+        self.timeout_message = timeout_message
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        self._timers = []
+
+        timer = QTimer()
+        timer.setSingleShot(True)
+        timer.timeout.connect(self._timed_out)
+        timer.start(int(timeout * 1000))
+        self._timers.append(timer)
+        if poll:
+            timer = QTimer()
+            timer.timeout.connect(self.check)
+            timer.start(int(session.wait_poll_interval * 1000))
+            self._timers.append(timer)
+
+    def check(self):
+        """Resolves the future if the condition is met."""
+        if self.future.done():
+            return
+        try:
+            if not self.condition():
+                return
+            value = self.result()
+        except Exception as e:
+            self._stop()
+            self.future.set_exception(e)
+        else:
+            self._stop()
+            self.future.set_result(value)
+
+    def fail(self, exception):
+        """Stops watching, and fails the future with given exception."""
+        if not self.future.done():
+            self._stop()
+            self.future.set_exception(exception)
+
+    def _timed_out(self):
+        if not self.future.done():
+            self._stop()
+            self.future.set_exception(TimeoutError(self.timeout_message))
+
+    def _stop(self):
+        for timer in self._timers:
+            timer.stop()
+        self._timers = []
+        if self in self.session._watchers:
+            self.session._watchers.remove(self)
+
+
+class Metrics(object):
+    """In-process registry of the metrics reported by Ghost when passed to
+    `Ghost`. `exposition()` renders them in the Prometheus text format.
+
+    Any object with the same `increment()`, `add()` and `observe()`
+    methods can be used instead, e.g. to forward metrics to StatsD.
+
+    :param prefix: The prefix of the exposed metric names.
+    :param buckets: The upper bounds of the histograms buckets.
+    """
+    default_buckets = (
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+    )
+
+    def __init__(self, prefix='ghost_', buckets=None):
+        self.prefix = prefix
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.counters = defaultdict(int)
+        self.gauges = defaultdict(int)
+        self.histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        """Increments a counter.
+
+        :param name: The counter name.
+        :param value: The increment.
+        :param labels: The metric labels.
+        """
+        self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def add(self, name, value, **labels):
+        """Adds a possibly negative value to a gauge.
+
+        :param name: The gauge name.
+        :param value: The value to add.
+        :param labels: The metric labels.
+        """
+        self.gauges[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name, value, **labels):
+        """Records a value, e.g. a duration in seconds, in a histogram.
+
+        :param name: The histogram name.
+        :param value: The observed value.
+        :param labels: The metric labels.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [
+                [0] * len(self.buckets), 0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram[0][index] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+
+    def exposition(self):
+        """Returns the metrics in the Prometheus text format."""
+        lines = []
+        for kind, metrics in (
+            ('counter', self.counters),
+            ('gauge', self.gauges),
+        ):
+            for name in sorted(set(name for name, _ in metrics)):
+                lines.append('# TYPE %s%s %s' % (self.prefix, name, kind))
+                for (other, labels), value in sorted(metrics.items()):
+                    if other == name:
+                        lines.append('%s%s%s %s' % (
+                            self.prefix, name, self._labels(labels), value))
+
+        for name in sorted(set(name for name, _ in self.histograms)):
+            lines.append('# TYPE %s%s histogram' % (self.prefix, name))
+            for (other, labels), histogram in sorted(
+                self.histograms.items()
+            ):
+                if other != name:
+                    continue
+                counts, total, count = histogram
+                cumulated = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulated += bucket
+                    lines.append('%s%s_bucket%s %s' % (
+                        self.prefix,
+                        name,
+                        self._labels(labels + (('le', repr(bound)),)),
+                        cumulated,
+                    ))
+                lines.append('%s%s_bucket%s %s' % (
+                    self.prefix,
+                    name,
+                    self._labels(labels + (('le', '+Inf'),)),
+                    count,
+                ))
+                lines.append('%s%s_sum%s %r' % (
+                    self.prefix, name, self._labels(labels), total))
+                lines.append('%s%s_count%s %s' % (
+                    self.prefix, name, self._labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def _labels(self, labels):
+        if not labels:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (
+                name,
+                str(value).replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n'),
+            )
+            for name, value in labels
+        )
+
+
+class Tracer(object):
+    """Records a span for each traced operation of the sessions it is
+    given to, see `Session`. Spans can be exported as Chrome trace events
+    to be opened in a timeline viewer (chrome://tracing, Perfetto).
+
+    A span is a dict holding the operation `name`, the `session` id, its
+    `started` epoch time and `duration`, the time spent in Qt event loops
+    (`event_loop`, `idle` being the part spent sleeping), the time spent
+    evaluating `javascript`, the number of `resources` released and the
+    `error` raised, if any. Durations are in seconds.
+    """
+    def __init__(self):
+        self.spans = []
+        self._threads = {}
+
+    @contextmanager
+    def span(self, session, name):
+        """Records a span for the enclosed operation.
+
+        :param session: The `Session` running the operation.
+        :param name: The operation name.
+        """
+        started_at = time.time()
+        wait_time = session.wait_time
+        idle_time = session.idle_time
+        javascript_time = session.javascript_time
+        released = session.released_resources
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+            raise
+        finally:
+            self.spans.append({
+                'name': name,
+                'session': session.id,
+                'started': started_at,
+                'duration': time.time() - started_at,
+                'event_loop': session.wait_time - wait_time,
+                'idle': session.idle_time - idle_time,
+                'javascript': session.javascript_time - javascript_time,
+                'resources': session.released_resources - released,
+                'error': error,
+            })
+
+    def trace_events(self):
+        """Returns the spans as a list of Chrome trace events."""
+        events = []
+        for span in self.spans:
+            tid = self._threads.setdefault(
+                span['session'], len(self._threads) + 1)
+            args = dict(
+                (key, value) for key, value in span.items()
+                if key not in ('name', 'started', 'duration')
+            )
+            events.append({
+                'name': span['name'],
+                'cat': 'ghost',
+                'ph': 'X',
+                'ts': int(span['started'] * 1000000),
+                'dur': int(span['duration'] * 1000000),
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': args,
+            })
+        return events
+
+    def save(self, path):
+        """Writes the spans to a Chrome trace-event JSON file.
+
+        :param path: The destination path.
+        """
+        with codecs.open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'traceEvents': self.trace_events(),
+                'displayTimeUnit': 'ms',
+            }, f)
+
+
+class EventLoopClock(object):
+    """Measures how long the Qt event loop sleeps waiting for events, as
+    opposed to processing them, while it is started.
+    """
+    def __init__(self):
+        self.idle = 0
+        self._blocked_at = None
+        self._users = 0
+
+    def start(self):
+        if not self._users:
+            dispatcher = QAbstractEventDispatcher.instance()
+            dispatcher.aboutToBlock.connect(self._about_to_block)
+            dispatcher.awake.connect(self._awake)
+        self._users += 1
+
+    def stop(self):
+        self._users -= 1
+        if not self._users:
+            dispatcher = QAbstractEventDispatcher.instance()
+            dispatcher.aboutToBlock.disconnect(self._about_to_block)
+            dispatcher.awake.disconnect(self._awake)
+            self._blocked_at = None
+
+    def _about_to_block(self):
+        self._blocked_at = time.time()
+
+    def _awake(self):
+        if self._blocked_at is not None:
+            self.idle += time.time() - self._blocked_at
+            self._blocked_at = None
+
 
 class Ghost(object):
     """`Ghost` manages a Qt application.
@@ -252,14 +2006,21 @@ class Ghost(object):
     :param plugin_path: Array with paths to plugin directories
         (default ['/usr/lib/mozilla/plugins'])
     :param defaults: The defaults arguments to pass to new child sessions.
+    :param metrics: An optional `Metrics` registry, or compatible object,
+        the sessions report to.
+    :param encoder_workers: The number of threads encoding screenshots,
+        see `image_encoder`.
     """
     _app = None
+    _image_encoder = None
 
     def __init__(
         self,
         plugin_path=['/usr/lib/mozilla/plugins', ],
         defaults=None,
         display_size=(1600, 900),
+        metrics=None,
+        encoder_workers=None,
     ):
         self.logger = logger.getChild('application')
 
@@ -282,6 +2043,9 @@ class Ghost(object):
         Ghost._app = QApplication.instance() or QApplication(['ghost'])
 
         qInstallMessageHandler(QTMessageProxy(logging.getLogger('qt')))
+        self.clock = EventLoopClock()
+        self.metrics = metrics
+        self.encoder_workers = encoder_workers
 
         if plugin_path:
             for p in plugin_path:
@@ -293,20 +2057,171 @@ class Ghost(object):
         self.defaults = _defaults
 
     def exit(self):
+        if self._image_encoder is not None:
+            self._image_encoder.shutdown()
+            self._image_encoder = None
         self._app.quit()
         if hasattr(self, 'xvfb'):
             self.xvfb.stop()
 
+    @property
+    def image_encoder(self):
+        """The `ImageEncoder` shared by the sessions, started on first
+        use.
+        """
+        if self._image_encoder is None:
+            self._image_encoder = ImageEncoder(self.encoder_workers)
+        return self._image_encoder
+
     def start(self, **kwargs):
         """Starts a new `Session`."""
         _kwargs = self.defaults.copy()
         _kwargs.update(kwargs)
         return Session(self, **_kwargs)
 
+    def wait(self, futures, timeout=None):
+        """Processes Qt events until all given futures are done, so that
+        many sessions make progress on a single event loop.
+
+        :param futures: The futures returned by `Session` `*_async` methods.
+        :param timeout: An optional timeout in second.
+        :return: The futures results.
+        """
+        futures = list(futures)
+        loop = QEventLoop()
+
+        def done(future):
+            if all(f.done() for f in futures):
+                # Futures may be resolved by other threads (e.g. encoding
+                # ones), the loop is stopped from its own.
+                QMetaObject.invokeMethod(loop, 'quit', Qt.QueuedConnection)
+
+        for future in futures:
+            future.add_done_callback(done)
+        if not all(f.done() for f in futures):
+            if timeout is not None:
+                QTimer.singleShot(int(timeout * 1000), loop.quit)
+            loop.exec_()
+        if not all(f.done() for f in futures):
+            raise TimeoutError('Futures are still pending')
+        return [f.result() for f in futures]
+
+    def pool(self, max_size=4, max_idle=300, **kwargs):
+        """Returns a new `SessionPool`.
+
+        :param max_size: The maximum number of sessions.
+        :param max_idle: The number of seconds after which an idle session
+            gets closed.
+        :param kwargs: The arguments to start sessions with.
+        """
+        return SessionPool(self, max_size=max_size, max_idle=max_idle,
+                           **kwargs)
+
     def __del__(self):
         self.exit()
 
 
+class SessionPool(object):
+    """`SessionPool` keeps started sessions around so that they can be
+    reused, once reset, instead of building new ones.
+
+    QtWebKit local storage is shared by all the pages of the process, so
+    pooled sessions have it disabled unless `local_storage_enabled` is
+    given; `Session.reset()` then clears it for the origins a session
+    visited, in all sessions. Session storage and cookies are per session
+    and cleared on reset. IndexedDB, Web SQL databases, the application
+    cache and the `HttpCache` aren't cleared.
+
+    :param ghost: The parent `Ghost` instance.
+    :param max_size: The maximum number of sessions.
+    :param max_idle: The number of seconds after which an idle session
+        gets closed.
+    :param kwargs: The arguments to start sessions with.
+    """
+    def __init__(self, ghost, max_size=4, max_idle=300, **kwargs):
+        self.ghost = ghost
+        self.max_size = max_size
+        self.max_idle = max_idle
+        kwargs.setdefault('local_storage_enabled', False)
+        self.kwargs = kwargs
+        self.logger = logger.getChild('pool')
+        self._idle = []
+        self._busy = set()
+
+    def __len__(self):
+        return len(self._idle) + len(self._busy)
+
+    def checkout(self):
+        """Returns a healthy idle session, or a new one."""
+        self.evict()
+        while self._idle:
+            session, _ = self._idle.pop()
+            if self._is_healthy(session):
+                self._busy.add(session)
+                return session
+            self.logger.warning('Closing unhealthy session %s', session.id)
+            self._close(session)
+
+        if len(self._busy) >= self.max_size:
+            raise Error('No session available in pool')
+        session = self.ghost.start(**self.kwargs)
+        self._busy.add(session)
+        return session
+
+    def checkin(self, session):
+        """Resets the session and puts it back in the pool.
+
+        :param session: A session obtained from `checkout()`.
+        """
+        self._busy.discard(session)
+        try:
+            session.reset()
+        except Exception:
+            self.logger.exception('Unable to reset session %s', session.id)
+            self._close(session)
+        else:
+            self._idle.append((session, time.time()))
+        self.evict()
+
+    @contextmanager
+    def session(self):
+        """Statement that checks out a session and checks it in back."""
+        session = self.checkout()
+        try:
+            yield session
+        finally:
+            self.checkin(session)
+
+    def evict(self):
+        """Closes the sessions idle for more than `max_idle` seconds."""
+        expires_at = time.time() - self.max_idle
+        for session, idle_since in list(self._idle):
+            if idle_since < expires_at:
+                self._idle.remove((session, idle_since))
+                self._close(session)
+
+    def close(self):
+        """Closes all the sessions."""
+        for session, _ in self._idle:
+            self._close(session)
+        for session in self._busy:
+            self._close(session)
+        self._idle = []
+        self._busy = set()
+
+    def _close(self, session):
+        try:
+            session.exit()
+        except Exception:
+            self.logger.exception('Unable to close session %s', session.id)
+
+    def _is_healthy(self, session):
+        try:
+            return session.evaluate('1 + 1;')[0] == 2
+        except Exception:
+            return False
+
+
 class Session(object):
     """`Session` manages a QWebPage.
 
@@ -315,6 +2230,12 @@ class Session(object):
     :param wait_timeout: Maximum step duration in second.
     :param wait_callback: An optional callable that is periodically
         executed until Ghost stops waiting.
+    :param wait_poll_interval: Maximum delay in second between two
+        condition checks when waiting for something that isn't notified
+        by a Qt signal (e.g. a DOM change).
+    :param settle_timeout: Maximum delay in second waited for after a
+        page is loaded, for the requests still in flight (e.g. started by
+        onload handlers) to finish.
     :param log_level: The optional logging level.
     :param log_handler: The optional logging handler.
     :param display: A boolean that tells ghost to displays UI.
@@ -325,6 +2246,20 @@ class Session(object):
     :param download_images: Indicate if the browser should download images
     :param exclude: A regex use to determine which url exclude
         when sending a request
+    :param request_scheduler: An optional `RequestScheduler` that limits
+        concurrent requests and request rate per host.
+    :param interceptors: An optional list of request interceptors (e.g. a
+        `Blocklist`), see `NetworkAccessManager.intercept()`.
+    :param loading_profile: An optional `LoadingProfile`, or its name
+        ('full', 'no-media' or 'text-only'), telling which resource types
+        not to load.
+    :param resource_policy: An optional `ResourcePolicy` that tells which
+        response bodies are retained in `http_resources`.
+    :param http_cache: An optional `HttpCache`, caching is disabled
+        otherwise.
+    :param har: An optional `HarArchive` the requests are recorded to, or
+        replayed from.
+    :param tracer: An optional `Tracer` recording the session operations.
     :param local_storage_enabled: An optional boolean to enable / disable
         local storage.
     """
@@ -340,6 +2275,8 @@ class Session(object):
         user_agent=default_user_agent,
         wait_timeout=8,
         wait_callback=None,
+        wait_poll_interval=0.1,
+        settle_timeout=0.5,
         display=False,
         viewport_size=None,
         ignore_ssl_errors=True,
@@ -349,6 +2286,13 @@ class Session(object):
         download_images=True,
         show_scrollbars=True,
         exclude=None,
+        request_scheduler=None,
+        interceptors=None,
+        loading_profile=None,
+        resource_policy=None,
+        http_cache=None,
+        har=None,
+        tracer=None,
         network_access_manager_class=NetworkAccessManager,
         web_page_class=GhostWebPage,
         local_storage_enabled=True,
@@ -362,11 +2306,34 @@ class Session(object):
             {'session': self.id},
         )
         self.logger.info("Starting new session")
+        self.metrics = ghost.metrics
+        if self.metrics is not None:
+            self.metrics.add('sessions', 1)
 
         self.http_resources = []
+        self.blocked_resources = []
+        self.waterfall = Waterfall([])
+        self.resource_policy = resource_policy or ResourcePolicy()
 
         self.wait_timeout = wait_timeout
         self.wait_callback = wait_callback
+        self.wait_poll_interval = wait_poll_interval
+        self.settle_timeout = settle_timeout
+        self._settle_deadline = 0
+        self.wait_time = 0
+        self.idle_time = 0
+        self.javascript_time = 0
+        self._pending_waits = []
+        self._page_waits = (0, 0)
+        self.released_resources = 0
+        self.tracer = tracer
+        self._event_loops = []
+        self._watchers = []
+        self._watchers_check_pending = False
+        self._bridge = GhostBridge(self)
+        self._observers = {}
+        self._observer_ids = itertools.count()
+        self._origins = set()
         self.ignore_ssl_errors = ignore_ssl_errors
         self.loaded = True
 
@@ -375,13 +2342,27 @@ class Session(object):
         self.popup_messages = []
         self.page = web_page_class(self.ghost._app, self)
 
+        if isinstance(loading_profile, str):
+            loading_profile = LoadingProfile.named(loading_profile)
+        self.loading_profile = loading_profile
+        if loading_profile is not None:
+            interceptors = [loading_profile] + list(interceptors or [])
+
         if network_access_manager_class is not None:
-            self.page.setNetworkAccessManager(
-                network_access_manager_class(exclude_regex=exclude))
+            manager = network_access_manager_class(exclude_regex=exclude)
+            # Set afterwards, so that subclasses written for the former
+            # constructor signature keep working.
+            manager.scheduler = request_scheduler
+            manager.resource_policy = self.resource_policy
+            manager.interceptors = list(interceptors or [])
+            manager.archive = har
+            manager.metrics = self.metrics
+            self.page.setNetworkAccessManager(manager)
 
         QWebSettings.setMaximumPagesInCache(0)
         QWebSettings.setObjectCacheCapacities(0, 0, 0)
-        QWebSettings.globalSettings().setAttribute(
+        # Page level, so that it doesn't change other sessions settings.
+        self.page.settings().setAttribute(
             QWebSettings.LocalStorageEnabled, local_storage_enabled)
 
         self.page.setForwardUnsupportedContent(True)
@@ -412,6 +2393,10 @@ class Session(object):
         self.page.unsupportedContent.connect(self._unsupported_content)
 
         self.manager = self.page.networkAccessManager()
+        self.har = har
+        self.http_cache = http_cache
+        if http_cache is not None:
+            self.manager.setCache(http_cache.create())
         self.manager.finished.connect(self._request_ended)
         self.manager.sslErrors.connect(self._on_manager_ssl_errors)
 
@@ -420,6 +2405,7 @@ class Session(object):
         self.manager.setCookieJar(self.cookie_jar)
 
         # User Agent
+        self.user_agent = user_agent
         self.page.set_user_agent(user_agent)
 
         self.page.networkAccessManager().authenticationRequired\
@@ -487,8 +2473,9 @@ class Session(object):
         """
         self.logger.debug('Calling `%s` method on `%s`', method, selector)
         element = self.main_frame.findFirstElement(selector)
-        return element.evaluateJavaScript('this[%s]();' % repr(method))
+        return self._run_javascript(element, 'this[%s]();' % repr(method))
 
+    @traced
     def capture(
         self,
         region=None,
@@ -502,6 +2489,7 @@ class Session(object):
         :param selector: A selector targeted the element to crop on.
         :param format: The output image format.
         """
+        started_at = time.time()
 
         if format is None:
             format = QImage.Format_ARGB32_Premultiplied
@@ -514,47 +2502,299 @@ class Session(object):
             Qt.Horizontal,
             Qt.ScrollBarAlwaysOff,
         )
-        frame_size = self.main_frame.contentsSize()
-        max_size = 23170 * 23170
-        if frame_size.height() * frame_size.width() > max_size:
-            self.logger.warning("Frame size is too large.")
-            default_size = self.page.viewportSize()
-            if default_size.height() * default_size.width() > max_size:
-                return None
-        else:
-            self.page.setViewportSize(self.main_frame.contentsSize())
-
-        self.logger.info("Frame size -> %s", str(self.page.viewportSize()))
-
-        image = QImage(self.page.viewportSize(), format)
-        painter = QPainter(image)
 
         if region is None and selector is not None:
             region = self.region_for_selector(selector)
 
         if region:
-            x1, y1, x2, y2 = region
-            w, h = (x2 - x1), (y2 - y1)
-            reg = QRegion(x1, y1, w, h)
-            self.main_frame.render(painter, reg)
+            image = self._capture_region(region, format)
         else:
+            frame_size = self.main_frame.contentsSize()
+            max_size = 23170 * 23170
+            if frame_size.height() * frame_size.width() > max_size:
+                self.logger.warning(
+                    "Frame size is too large, see capture_tiles().")
+                default_size = self.page.viewportSize()
+                if default_size.height() * default_size.width() > max_size:
+                    return None
+            else:
+                self.page.setViewportSize(self.main_frame.contentsSize())
+
+            self.logger.info(
+                "Frame size -> %s", str(self.page.viewportSize()))
+
+            image = QImage(self.page.viewportSize(), format)
+            painter = QPainter(image)
             self.main_frame.render(painter)
+            painter.end()
 
-        painter.end()
+        if self.metrics is not None:
+            self.metrics.observe('capture_seconds', time.time() - started_at)
+        return image
 
-        if region:
-            x1, y1, x2, y2 = region
-            w, h = (x2 - x1), (y2 - y1)
-            image = image.copy(x1, y1, w, h)
+    def capture_array(self, region=None, selector=None, format=None):
+        """Returns snapshot as a NumPy array of shape (height, width, 4),
+        that shares the pixels of the rendered QImage, with no copy. NumPy
+        is required.
+
+        :param region: An optional tuple containing region as pixel
+            coodinates.
+        :param selector: A selector targeted the element to crop on.
+        :param format: The image format, a 32 bits per pixel one. Defaults
+            to RGBA8888, i.e. RGBA channels order.
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise Error('NumPy is required to capture images as arrays')
+
+        if format is None:
+            format = QImage.Format_RGBA8888
+        image = self.capture(region=region, selector=selector, format=format)
+        if image is None:
+            return None
+        return numpy.asarray(ImageBuffer(image))
+
+    def _capture_region(self, region, format):
+        """Renders a region of the frame in an image of its size only. The
+        frame is scrolled to the region if needed, then back, so that the
+        viewport doesn't have to be resized unless the region doesn't fit
+        in it.
+        """
+        x1, y1, x2, y2 = region
+        w, h = (x2 - x1), (y2 - y1)
+        viewport_size = self.page.viewportSize()
+        if w > viewport_size.width() or h > viewport_size.height():
+            tiles = self.capture_tiles(
+                tile_size=(w, h),
+                region=region,
+                format=format,
+            )
+            try:
+                _, _, image = next(tiles)
+            finally:
+                # Restores the viewport now, not when garbage collected.
+                tiles.close()
+            return image
+
+        position = self.main_frame.scrollPosition()
+        scrolled = not QRect(position, viewport_size).contains(
+            QRect(x1, y1, w, h))
+        if scrolled:
+            self.main_frame.setScrollPosition(QPoint(x1, y1))
+        scroll = self.main_frame.scrollPosition()
+        x, y = x1 - scroll.x(), y1 - scroll.y()
+
+        image = QImage(w, h, format)
+        painter = QPainter(image)
+        painter.translate(-x, -y)
+        self.main_frame.render(painter, QRegion(x, y, w, h))
+        painter.end()
 
+        if scrolled:
+            self.main_frame.setScrollPosition(position)
         return image
 
+    def capture_tiles(
+        self,
+        tile_size=(1024, 1024),
+        region=None,
+        selector=None,
+        format=None,
+    ):
+        """Renders the frame, or a region of it, tile by tile so that
+        memory use is bounded by the tile size whatever the page size,
+        which allows to capture pages beyond the 23170x23170 pixels a
+        single image is limited to.
+
+        The viewport is resized to the frame contents while tiles are
+        rendered, then restored.
+
+        :param tile_size: The maximum (width, height) of a tile.
+        :param region: An optional tuple containing region as pixel
+            coodinates.
+        :param selector: A selector targeted the element to crop on.
+        :param format: The tiles image format.
+        :return: A generator of (x, y, QImage) tuples, row by row, tiles
+            positions being relative to the region.
+        """
+        if format is None:
+            format = QImage.Format_ARGB32_Premultiplied
+        tile_width, tile_height = tile_size
+
+        self.main_frame.setScrollBarPolicy(
+            Qt.Vertical,
+            Qt.ScrollBarAlwaysOff,
+        )
+        self.main_frame.setScrollBarPolicy(
+            Qt.Horizontal,
+            Qt.ScrollBarAlwaysOff,
+        )
+        if region is None and selector is not None:
+            region = self.region_for_selector(selector)
+        if region is None:
+            frame_size = self.main_frame.contentsSize()
+            region = (0, 0, frame_size.width(), frame_size.height())
+        x1, y1, x2, y2 = region
+
+        viewport_size = self.page.viewportSize()
+        self.page.setViewportSize(self.main_frame.contentsSize())
+        try:
+            for y in range(y1, y2, tile_height):
+                for x in range(x1, x2, tile_width):
+                    w = min(tile_width, x2 - x)
+                    h = min(tile_height, y2 - y)
+                    image = QImage(w, h, format)
+                    painter = QPainter(image)
+                    painter.translate(-x, -y)
+                    self.main_frame.render(painter, QRegion(x, y, w, h))
+                    painter.end()
+                    yield x - x1, y - y1, image
+        finally:
+            self.page.setViewportSize(viewport_size)
+
+    @traced
+    def capture_tiles_to(
+        self,
+        directory,
+        tile_size=(1024, 1024),
+        region=None,
+        selector=None,
+        format=None,
+        image_format='png',
+    ):
+        """Saves the tiles rendered by `capture_tiles()` as image files,
+        one tile at a time.
+
+        :param directory: The destination directory.
+        :param tile_size: The maximum (width, height) of a tile.
+        :param region: An optional tuple containing region as pixel
+            coodinates.
+        :param selector: A selector targeted the element to crop on.
+        :param format: The tiles image format.
+        :param image_format: The file format, also used as extension.
+        :return: A list of (x, y, path) tuples, see `stitch_tiles()`.
+        """
+        tiles = []
+        for x, y, image in self.capture_tiles(
+            tile_size=tile_size,
+            region=region,
+            selector=selector,
+            format=format,
+        ):
+            path = os.path.join(
+                directory,
+                'tile-%d-%d.%s' % (y, x, image_format.lower()),
+            )
+            if not image.save(path, image_format.upper()):
+                raise Error('Unable to save tile %s' % path)
+            tiles.append((x, y, path))
+        return tiles
+
+    @traced
+    def capture_many(
+        self,
+        selectors,
+        directory=None,
+        format=None,
+        image_format='png',
+        quality=-1,
+        compression=None,
+    ):
+        """Captures many elements at once: their regions are extracted by
+        a single query, and the page is laid out once for all of them.
+        Each element is then rendered in an image of its own size, and
+        encoded by the Ghost `image_encoder` threads when saved, while the
+        next ones get rendered.
+
+        :param selectors: A dict mapping names to selectors, or a list of
+            selectors used as names.
+        :param directory: An optional directory to save the images to, as
+            `<name>.<image_format>` files. Characters of names that aren't
+            allowed in file names are replaced by `_`, names that end up
+            the same get a `-2`, `-3`... suffix, in sorted order.
+        :param format: The images format.
+        :param image_format: The file format, also used as extension.
+        :param quality: The JPEG or WebP quality, from 0 to 100.
+        :param compression: An optional PNG compression level, from 0 to 9.
+        :return: A dict mapping names to QImage objects, or to file paths
+            when saving them, None for the elements that can't be found or
+            aren't displayed.
+        """
+        if not isinstance(selectors, dict):
+            selectors = dict((selector, selector) for selector in selectors)
+        if format is None:
+            format = QImage.Format_ARGB32_Premultiplied
+        if directory is not None:
+            paths = {}
+            used = set()
+            for name in sorted(selectors):
+                stem = re.sub(r'[^\w.-]+', '_', name)
+                filename = '%s.%s' % (stem, image_format.lower())
+                suffix = 1
+                while filename.lower() in used:
+                    suffix += 1
+                    filename = '%s-%d.%s' % (
+                        stem, suffix, image_format.lower())
+                used.add(filename.lower())
+                paths[name] = os.path.join(directory, filename)
+
+        self.main_frame.setScrollBarPolicy(
+            Qt.Vertical,
+            Qt.ScrollBarAlwaysOff,
+        )
+        self.main_frame.setScrollBarPolicy(
+            Qt.Horizontal,
+            Qt.ScrollBarAlwaysOff,
+        )
+        viewport_size = self.page.viewportSize()
+        self.page.setViewportSize(self.main_frame.contentsSize())
+
+        results = {}
+        try:
+            found = self.query_many(dict(
+                (name, {'selector': selector, 'text': False, 'region': True})
+                for name, selector in selectors.items()
+            ))
+            for name, item in found.items():
+                if item is None:
+                    results[name] = None
+                    continue
+                x1, y1, x2, y2 = item['region']
+                w, h = (x2 - x1), (y2 - y1)
+                if w <= 0 or h <= 0:
+                    # Hidden element.
+                    results[name] = None
+                    continue
+                image = QImage(w, h, format)
+                painter = QPainter(image)
+                painter.translate(-x1, -y1)
+                self.main_frame.render(painter, QRegion(x1, y1, w, h))
+                painter.end()
+                if directory is None:
+                    results[name] = image
+                    continue
+                results[name] = self.ghost.image_encoder.save(
+                    image, paths[name], image_format, quality, compression)
+        finally:
+            self.page.setViewportSize(viewport_size)
+
+        if directory is not None:
+            for name, result in results.items():
+                if result is not None:
+                    results[name] = result.result()
+        return results
+
+    @traced
     def capture_to(
         self,
         path,
         region=None,
         selector=None,
         format=None,
+        image_format=None,
+        quality=-1,
+        compression=None,
     ):
         """Saves snapshot as image.
 
@@ -563,14 +2803,54 @@ class Session(object):
             coodinates.
         :param selector: A selector targeted the element to crop on.
         :param format: The output image format.
+        :param image_format: The file format, guessed from the path
+            extension by default.
+        :param quality: The JPEG or WebP quality, from 0 to 100.
+        :param compression: An optional PNG compression level, from 0 to 9.
         """
 
         if format is None:
             format = QImage.Format_ARGB32_Premultiplied
 
-        self.capture(region=region, format=format,
-                     selector=selector).save(path)
+        write_image(
+            self.capture(region=region, format=format, selector=selector),
+            path,
+            image_format,
+            quality,
+            compression,
+        )
+
+    @traced
+    def capture_to_async(
+        self,
+        path,
+        region=None,
+        selector=None,
+        format=None,
+        image_format=None,
+        quality=-1,
+        compression=None,
+    ):
+        """Non-blocking `capture_to()`: the snapshot is rendered, then
+        encoded by the Ghost `image_encoder` threads while the Qt event loop
+        goes on.
+
+        Takes the same arguments as `capture_to()`.
+
+        :return: A Future resolved with the path once the image is saved.
+        """
+        if format is None:
+            format = QImage.Format_ARGB32_Premultiplied
+
+        return self.ghost.image_encoder.save(
+            self.capture(region=region, format=format, selector=selector),
+            path,
+            image_format,
+            quality,
+            compression,
+        )
 
+    @traced
     def print_to_pdf(
         self,
         path,
@@ -672,7 +2952,7 @@ class Session(object):
         :param script: The script to evaluate.
         """
         return (
-            self.main_frame.evaluateJavaScript("%s" % script),
+            self._run_javascript(self.main_frame, "%s" % script),
             self._release_last_resources(),
         )
 
@@ -686,6 +2966,16 @@ class Session(object):
         with codecs.open(path, encoding=encoding) as f:
             return self.evaluate(f.read(), **kwargs)
 
+    def _run_javascript(self, target, script):
+        """Evaluates script on a frame or an element, accounting for the
+        time spent in `javascript_time`.
+        """
+        started_at = time.time()
+        try:
+            return target.evaluateJavaScript(script)
+        finally:
+            self.javascript_time += time.time() - started_at
+
     def exists(self, selector):
         """Checks if element exists for given selector.
 
@@ -695,9 +2985,38 @@ class Session(object):
 
     def exit(self):
         """Exits all Qt widgets."""
+        self._start_exit()
+        self.sleep()
+        self._finish_exit()
+
+    def exit_async(self):
+        """Non-blocking `exit()`, returns a Future resolved once the Qt
+        events the page deletion needs have been processed.
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def finish():
+            self._finish_exit()
+            future.set_result(None)
+
+        self._start_exit()
+        QTimer.singleShot(100, finish)
+        return future
+
+    def _start_exit(self):
         self.logger.info("Closing session")
+        for watcher in list(self._watchers):
+            watcher.fail(Error('Session exited'))
+        for observer_id in list(self._observers):
+            self._disconnect_observer(observer_id)
+        if self.metrics is not None:
+            self.metrics.add('sessions', -1)
+        if self.har is not None and self.har.mode == 'record':
+            self.har.save()
         self.page.deleteLater()
-        self.sleep()
+
+    def _finish_exit(self):
         del self.webview
         del self.cookie_jar
         del self.manager
@@ -707,15 +3026,119 @@ class Session(object):
     def fill(self, selector, values):
         """Fills a form with provided values.
 
+        All the fields but file inputs are filled, and their input, change
+        and blur events dispatched, by a single script evaluation.
+
         :param selector: A CSS selector to the target form to fill.
         :param values: A dict containing the values.
         """
         if not self.exists(selector):
             raise Error("Can't find form")
+        fields = [
+            ["%s [name=%s]" % (selector, repr(field)), values[field]]
+            for field in values
+        ]
+        for field_selector, value in fields:
+            self.logger.debug('Setting value "%s" for "%s"', value,
+                              field_selector)
+        result = self._run_javascript(self.main_frame, """
+            (function (fields) {
+                var textTypes = [
+                        'color', 'date', 'datetime', 'datetime-local',
+                        'email', 'hidden', 'month', 'number', 'password',
+                        'range', 'search', 'tel', 'text', 'time', 'url',
+                        'week', ''
+                    ],
+                    files = [];
+                function setChecked(el, checked) {
+                    el.focus();
+                    if (checked) {
+                        el.setAttribute('checked', 'checked');
+                    } else {
+                        el.removeAttribute('checked');
+                    }
+                    el.checked = checked;
+                }
+                function fire(el, name) {
+                    var event = document.createEvent('HTMLEvents');
+                    event.initEvent(name, true, true);
+                    el.dispatchEvent(event);
+                }
+                for (var i = 0; i < fields.length; i++) {
+                    var selector = fields[i][0],
+                        value = fields[i][1],
+                        els = document.querySelectorAll(selector),
+                        el = els[0],
+                        tagName,
+                        type,
+                        j;
+                    if (!el) {
+                        return JSON.stringify({missing: selector});
+                    }
+                    tagName = el.tagName.toLowerCase();
+                    type = (el.getAttribute('type') || '').toLowerCase();
+                    if (tagName === 'select') {
+                        el.focus();
+                        for (j = 0; j < el.options.length; j++) {
+                            if (el.options[j].getAttribute('value') ===
+                                    value) {
+                                el.options[j].selected = true;
+                                el.selectedIndex = j;
+                                break;
+                            }
+                        }
+                    } else if (tagName === 'textarea') {
+                        el.focus();
+                        el.textContent = value;
+                        el.value = value;
+                    } else if (tagName !== 'input') {
+                        return JSON.stringify({unsupported: selector});
+                    } else if (textTypes.indexOf(type) !== -1) {
+                        el.focus();
+                        el.setAttribute('value', value);
+                        el.value = value;
+                    } else if (type === 'checkbox') {
+                        if (els.length > 1) {
+                            for (j = 0; j < els.length; j++) {
+                                setChecked(
+                                    els[j],
+                                    els[j].getAttribute('value') === value
+                                );
+                            }
+                        } else {
+                            setChecked(el, value === true);
+                        }
+                    } else if (type === 'radio') {
+                        for (j = 0; j < els.length; j++) {
+                            if (els[j].getAttribute('value') === value) {
+                                els[j].focus();
+                                els[j].setAttribute('checked', 'checked');
+                                els[j].checked = true;
+                            }
+                        }
+                    } else if (type === 'file') {
+                        files.push(i);
+                        continue;
+                    }
+                    fire(el, 'input');
+                    fire(el, 'change');
+                    el.blur();
+                }
+                return JSON.stringify({files: files});
+            })(%s);
+        """ % json.dumps(fields))
+
+        if result is None:
+            raise Error("Unable to fill form")
+        result = json.loads(result)
+        if 'missing' in result:
+            raise Error('can\'t find element for %s"' % result['missing'])
+        if 'unsupported' in result:
+            raise Error('unsupported field tag')
+
         resources = []
-        for field in values:
-            r, res = self.set_field_value(
-                "%s [name=%s]" % (selector, repr(field)), values[field])
+        for index in result['files']:
+            r, res = self.set_field_value(*fields[index])
             resources.extend(res)
         return True, resources
 
@@ -728,7 +3151,7 @@ class Session(object):
         """
         self.logger.debug('Fire `%s` on `%s`', event, selector)
         element = self.main_frame.findFirstElement(selector)
-        return element.evaluateJavaScript("""
+        return self._run_javascript(element, """
             var event = document.createEvent("HTMLEvents");
             event.initEvent('%s', true, true);
             this.dispatchEvent(event);
@@ -789,6 +3212,53 @@ class Session(object):
         else:
             raise ValueError('unsupported cookie_storage type.')
 
+    def reset(self):
+        """Resets the session so that it can be reused: clears cookies,
+        the web storage of the origins visited since the last reset,
+        collected resources and popup messages, then loads about:blank.
+
+        Local storage is shared by all the sessions of the process, it is
+        cleared for the visited origins in the other sessions too.
+        """
+        self.logger.info("Resetting session")
+        self.frame()
+        self._clear_storage()
+        self.delete_cookies()
+        self._alert = None
+        self._confirm_expected = None
+        self._prompt_expected = None
+        self._upload_file = None
+        self.popup_messages = []
+        self.page.set_user_agent(self.user_agent)
+        self.open('about:blank')
+        self._release_last_resources()
+        if self.page.viewportSize() != QSize(*self.viewport_size):
+            self.set_viewport_size(*self.viewport_size)
+
+    def _clear_storage(self):
+        """Clears the web storage of the visited origins, loading an empty
+        document from each of them, without any request.
+        """
+        self._visit_origin(self.main_frame.url())
+        script = 'try { sessionStorage.clear(); } catch (e) {}'
+        if self.page.settings().testAttribute(
+            QWebSettings.LocalStorageEnabled
+        ):
+            script = (
+                'try { localStorage.clear(); } catch (e) {}\n' + script)
+        for origin in sorted(self._origins):
+            self.main_frame.setHtml('', QUrl(origin + '/'))
+            self._run_javascript(self.main_frame, script)
+        self._origins = set()
+
+    def _visit_origin(self, url):
+        if url.scheme() in ('http', 'https'):
+            self._origins.add(url.adjusted(
+                QUrl.RemoveUserInfo | QUrl.RemovePath | QUrl.RemoveQuery |
+                QUrl.RemoveFragment
+            ).toString())
+
+    @traced
     def open(
         self,
         address,
@@ -855,6 +3325,17 @@ class Session(object):
         if wait:
             return self.wait_for_page_loaded(timeout=timeout)
 
+    def open_async(self, address, timeout=None, **kwargs):
+        """Starts loading a web page without waiting for it.
+
+        Takes the same arguments as `open()`.
+
+        :return: A Future resolved with the page resource and all loaded
+            resources once the page is loaded.
+        """
+        self.open(address, wait=False, **kwargs)
+        return self.wait_for_page_loaded_async(timeout=timeout)
+
     def scroll_to_anchor(self, anchor):
         self.main_frame.scrollToAnchor(anchor)
 
@@ -868,6 +3349,175 @@ class Session(object):
         yield
         self._prompt_expected = None
 
+    def query_many(self, queries):
+        """Extracts data for many selectors in a single script evaluation.
+
+        Each query is either a CSS selector, that extracts the text of the
+        first matching element, or a dict with the following keys:
+
+        - `selector`: The CSS selector.
+        - `all`: Set to True to extract data for all the matching elements.
+        - `count`: Set to True to only return the number of matches.
+        - `text`: Whether to extract the element text (default True).
+        - `html`: Whether to extract the element outer HTML.
+        - `attributes`: A list of attribute names to extract, or True for
+          all of them.
+        - `region`: Whether to extract the element region as returned by
+          `region_for_selector()`.
+
+        :param queries: A dict mapping names to queries.
+        :return: A dict mapping names to the number of matches, an item
+            dict (None if nothing matches) or a list of item dicts.
+        """
+        specs = {}
+        for name, query in queries.items():
+            if isinstance(query, str):
+                query = {'selector': query}
+            spec = dict(text=True, html=False, attributes=None, region=False,
+                        all=False, count=False)
+            spec.update(query)
+            specs[name] = spec
+
+        result = self._run_javascript(self.main_frame, """
+            (function (specs) {
+                var results = {};
+                function extract(el, spec) {
+                    var item = {}, rect, i, name;
+                    if (spec.text) {
+                        item.text = el.innerText || el.textContent || '';
+                    }
+                    if (spec.html) {
+                        item.html = el.outerHTML;
+                    }
+                    if (spec.attributes === true) {
+                        item.attributes = {};
+                        for (i = 0; i < el.attributes.length; i++) {
+                            item.attributes[el.attributes[i].name] =
+                                el.attributes[i].value;
+                        }
+                    } else if (spec.attributes) {
+                        item.attributes = {};
+                        for (i = 0; i < spec.attributes.length; i++) {
+                            name = spec.attributes[i];
+                            item.attributes[name] = el.getAttribute(name);
+                        }
+                    }
+                    if (spec.region) {
+                        rect = el.getBoundingClientRect();
+                        item.region = [
+                            Math.round(rect.left + window.pageXOffset),
+                            Math.round(rect.top + window.pageYOffset)
+                        ];
+                        item.region.push(
+                            item.region[0] + Math.round(rect.width) - 1,
+                            item.region[1] + Math.round(rect.height) - 1
+                        );
+                    }
+                    return item;
+                }
+                Object.keys(specs).forEach(function (name) {
+                    var spec = specs[name], els, el;
+                    if (spec.count) {
+                        results[name] =
+                            document.querySelectorAll(spec.selector).length;
+                    } else if (spec.all) {
+                        els = document.querySelectorAll(spec.selector);
+                        results[name] = Array.prototype.map.call(
+                            els,
+                            function (el) { return extract(el, spec); }
+                        );
+                    } else {
+                        el = document.querySelector(spec.selector);
+                        results[name] = el ? extract(el, spec) : null;
+                    }
+                });
+                return JSON.stringify(results);
+            })(%s);
+        """ % json.dumps(specs))
+
+        if result is None:
+            raise Error('Unable to query selectors')
+        results = json.loads(result)
+        for name, value in results.items():
+            for item in value if isinstance(value, list) else [value]:
+                if isinstance(item, dict) and 'region' in item:
+                    item['region'] = tuple(item['region'])
+        return results
+
+    def page_metrics(self):
+        """Returns performance metrics of the current page as a dict:
+
+        - `navigation`: the main frame navigation timings in milliseconds,
+          durations for `redirect`, `dns`, `connect` and `response`, times
+          from navigation start for `ttfb`, `dom_interactive`,
+          `dom_content_loaded` and `load`; None if the browser doesn't
+          expose them.
+        - `resources`: the number of requests, blocked requests and bytes
+          received by `resource_type()`, for the requests summarized in
+          `waterfall`.
+        - `js_heap`: the used, total and limit JS heap sizes in bytes, or
+          None if the browser doesn't expose them.
+        - `ghost`: the seconds spent by the session in blocking waits since
+          the page load started, `wait`, split between the event loop
+          being `idle` and it `processing` events.
+        """
+        result = self._run_javascript(self.main_frame, """
+            (function () {
+                var performance = window.performance,
+                    result = {navigation: null, js_heap: null};
+                if (performance && performance.timing) {
+                    var t = performance.timing;
+                    var since = function (time) {
+                        return time ? time - t.navigationStart : null;
+                    };
+                    result.navigation = {
+                        redirect: t.redirectEnd - t.redirectStart,
+                        dns: t.domainLookupEnd - t.domainLookupStart,
+                        connect: t.connectEnd - t.connectStart,
+                        response: t.responseEnd - t.responseStart,
+                        ttfb: since(t.responseStart),
+                        dom_interactive: since(t.domInteractive),
+                        dom_content_loaded: since(
+                            t.domContentLoadedEventEnd),
+                        load: since(t.loadEventEnd)
+                    };
+                }
+                if (performance && performance.memory) {
+                    result.js_heap = {
+                        used: performance.memory.usedJSHeapSize,
+                        total: performance.memory.totalJSHeapSize,
+                        limit: performance.memory.jsHeapSizeLimit
+                    };
+                }
+                return JSON.stringify(result);
+            })();
+        """)
+        metrics = json.loads(result) if result else {
+            'navigation': None,
+            'js_heap': None,
+        }
+
+        resources = {}
+        for resource in self.waterfall.resources:
+            counts = resources.setdefault(resource.type, {
+                'requests': 0,
+                'blocked': 0,
+                'bytes': 0,
+            })
+            counts['requests'] += 1
+            counts['blocked'] += int(resource.blocked)
+            counts['bytes'] += resource.bytes_received
+        metrics['resources'] = resources
+        wait_time, idle_time = self._wait_totals()
+        wait_time -= self._page_waits[0]
+        idle_time -= self._page_waits[1]
+        metrics['ghost'] = {
+            'wait': wait_time,
+            'idle': idle_time,
+            'processing': wait_time - idle_time,
+        }
+        return metrics
+
     def region_for_selector(self, selector):
         """Returns frame region for given selector as tuple.
 
@@ -977,8 +3627,9 @@ class Session(object):
             index = 0
             for option in el.findAll('option'):
                 if option.attribute('value') == value:
-                    option.evaluateJavaScript('this.selected = true;')
-                    el.evaluateJavaScript('this.selectedIndex = %d;' % index)
+                    self._run_javascript(option, 'this.selected = true;')
+                    self._run_javascript(
+                        el, 'this.selectedIndex = %d;' % index)
                     break
                 index += 1
 
@@ -1097,6 +3748,7 @@ class Session(object):
         :param height: An integer that sets height pixel count.
         """
         new_size = QSize(width, height)
+        self.viewport_size = (width, height)
 
         self.webview.resize(new_size)
         self.page.setPreferredContentsSize(new_size)
@@ -1115,47 +3767,237 @@ class Session(object):
         self.sleep()
 
     def sleep(self, value=0.1):
-        started_at = time.time()
+        """Processes Qt events for `value` seconds without busy looping.
 
-        while time.time() <= (started_at + value):
-            time.sleep(0.01)
-            self.ghost._app.processEvents()
+        :param value: The duration in second.
+        """
+        loop = QEventLoop()
+        QTimer.singleShot(int(value * 1000), loop.quit)
+        with self._waiting():
+            loop.exec_()
 
-    def wait_for(self, condition, timeout_message, timeout=None):
+    def wait_for(
+        self,
+        condition,
+        timeout_message,
+        timeout=None,
+        poll=True,
+        name='wait_for',
+    ):
         """Waits until condition is True.
 
+        The condition is checked again each time the session gets notified
+        of a page, network or popup event and, when polling, at least every
+        `wait_poll_interval` seconds.
+
         :param condition: A callable that returns the condition.
         :param timeout_message: The exception message on timeout.
         :param timeout: An optional timeout.
+        :param poll: Set to False when the condition can only change on a
+            session event, so that no periodic check is needed.
+        :param name: The name the wait is reported as in metrics.
         """
         timeout = self.wait_timeout if timeout is None else timeout
+        poll = poll or self.wait_callback is not None
         started_at = time.time()
-        while not condition():
-            if time.time() > (started_at + timeout):
-                raise TimeoutError(timeout_message)
-            self.sleep()
-            if self.wait_callback is not None:
-                self.wait_callback()
+        try:
+            with self._waiting():
+                while not condition():
+                    remaining = started_at + timeout - time.time()
+                    if remaining <= 0:
+                        raise TimeoutError(timeout_message)
+                    if poll:
+                        remaining = min(remaining, self.wait_poll_interval)
+                    self._wait_for_event(remaining)
+                    if self.wait_callback is not None:
+                        self.wait_callback()
+        except TimeoutError:
+            if self.metrics is not None:
+                self.metrics.increment('wait_timeouts_total', wait=name)
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe(
+                    'wait_seconds', time.time() - started_at, wait=name)
+
+    @contextmanager
+    def _waiting(self):
+        """Accounts for the time spent in a blocking wait, and for how
+        much of it the event loop was idle.
+        """
+        clock = self.ghost.clock
+        started_at = time.time()
+        idle = clock.idle
+        clock.start()
+        self._pending_waits.append((started_at, idle))
+        try:
+            yield
+        finally:
+            self._pending_waits.remove((started_at, idle))
+            clock.stop()
+            self.wait_time += time.time() - started_at
+            self.idle_time += clock.idle - idle
+
+    def _wait_totals(self):
+        """Returns the wait and idle times so far, including the waits
+        in progress.
+        """
+        now = time.time()
+        wait_time, idle_time = self.wait_time, self.idle_time
+        for started_at, idle in self._pending_waits:
+            wait_time += now - started_at
+            idle_time += self.ghost.clock.idle - idle
+        return wait_time, idle_time
+
+    def _wait_for_event(self, timeout):
+        """Runs a nested event loop until the session gets woken up or
+        timeout is reached.
+
+        :param timeout: The maximum duration in second.
+        """
+        loop = QEventLoop()
+        timer = QTimer()
+        timer.setSingleShot(True)
+        timer.timeout.connect(loop.quit)
+        timer.start(max(0, int(timeout * 1000)))
+        self._event_loops.append(loop)
+        try:
+            loop.exec_()
+        finally:
+            timer.stop()
+            self._event_loops.remove(loop)
+
+    def wait_for_async(
+        self,
+        condition,
+        timeout_message,
+        timeout=None,
+        poll=True,
+        result=None,
+        name='wait_for',
+    ):
+        """Returns a Future resolved once condition is True, without
+        blocking. Futures are resolved while Qt events are processed, e.g.
+        by `Ghost.wait()`.
 
+        :param condition: A callable that returns the condition.
+        :param timeout_message: The exception message on timeout.
+        :param timeout: An optional timeout.
+        :param poll: Set to False when the condition can only change on a
+            session event, so that no periodic check is needed.
+        :param result: An optional callable that returns the future
+            result, True otherwise.
+        :param name: The name the wait is reported as in metrics.
+        """
+        watcher = Watcher(
+            self,
+            condition,
+            result or (lambda: True),
+            timeout_message,
+            self.wait_timeout if timeout is None else timeout,
+            poll=poll,
+        )
+        self._watchers.append(watcher)
+        if self.metrics is not None:
+            watcher.future.add_done_callback(
+                partial(self._record_wait, name, time.time()))
+        watcher.check()
+        return watcher.future
+
+    def _record_wait(self, name, started_at, future):
+        if isinstance(future.exception(), TimeoutError):
+            self.metrics.increment('wait_timeouts_total', wait=name)
+        self.metrics.observe(
+            'wait_seconds', time.time() - started_at, wait=name)
+
+    def _wake_up(self):
+        """Stops pending waits so that their condition gets checked.
+        Watchers are checked from the event loop, as this is called back
+        from script dialogs and network signals.
+        """
+        for loop in self._event_loops:
+            loop.quit()
+        if self._watchers and not self._watchers_check_pending:
+            self._watchers_check_pending = True
+            QTimer.singleShot(0, self._check_watchers)
+
+    def _check_watchers(self):
+        self._watchers_check_pending = False
+        for watcher in list(self._watchers):
+            watcher.check()
+
+    @traced
     def wait_for_alert(self, timeout=None):
         """Waits for main frame alert().
 
         :param timeout: An optional timeout.
         """
         self.wait_for(lambda: self._alert is not None,
-                      'User has not been alerted.', timeout)
+                      'User has not been alerted.', timeout,
+                      poll=False, name='wait_for_alert')
+        return self._alert_result()
+
+    def wait_for_alert_async(self, timeout=None):
+        """Non-blocking `wait_for_alert()`, returns a Future.
+
+        :param timeout: An optional timeout.
+        """
+        return self.wait_for_async(
+            lambda: self._alert is not None,
+            'User has not been alerted.',
+            timeout,
+            poll=False,
+            result=self._alert_result,
+            name='wait_for_alert',
+        )
+
+    def _alert_result(self):
         msg = self._alert
         self._alert = None
         return msg, self._release_last_resources()
 
+    @traced
     def wait_for_page_loaded(self, timeout=None):
         """Waits until page is loaded, assumed that a page as been requested.
+        The timings of the requests made meanwhile, blocked ones included,
+        are then summarized in `waterfall`.
+
+        :param timeout: An optional timeout.
+        """
+        self.wait_for(self._page_settled,
+                      'Unable to load requested page', timeout,
+                      poll=False, name='wait_for_page_loaded')
+        return self._page_loaded_result()
+
+    def wait_for_page_loaded_async(self, timeout=None):
+        """Non-blocking `wait_for_page_loaded()`, returns a Future.
 
         :param timeout: An optional timeout.
         """
-        self.wait_for(lambda: self.loaded,
-                      'Unable to load requested page', timeout)
+        return self.wait_for_async(
+            self._page_settled,
+            'Unable to load requested page',
+            timeout,
+            poll=False,
+            result=self._page_loaded_result,
+            name='wait_for_page_loaded',
+        )
+
+    def _page_settled(self):
+        """Tells if the page is loaded, and either the requests in flight
+        are done or `settle_timeout` is over.
+        """
+        if not self.loaded:
+            return False
+        return (
+            getattr(self.manager, 'in_flight', 0) <= 0 or
+            time.time() >= self._settle_deadline
+        )
+
+    def _page_loaded_result(self):
+        blocked = self.blocked_resources
         resources = self._release_last_resources()
+        self.waterfall = Waterfall(resources + blocked)
         page = None
 
         url = self.main_frame.url().toString()
@@ -1169,45 +4011,272 @@ class Session(object):
 
         return page, resources
 
+    @traced
     def wait_for_selector(self, selector, timeout=None):
         """Waits until selector match an element on the frame.
 
         :param selector: The selector to wait for.
         :param timeout: An optional timeout.
         """
-        self.wait_for(
-            lambda: self.exists(selector),
+        self._wait_for_selector(
+            selector,
+            True,
             'Can\'t find element matching "%s"' % selector,
             timeout,
         )
         return True, self._release_last_resources()
 
+    def wait_for_selector_async(self, selector, timeout=None):
+        """Non-blocking `wait_for_selector()`, returns a Future.
+
+        :param selector: The selector to wait for.
+        :param timeout: An optional timeout.
+        """
+        return self._wait_for_selector_async(
+            selector,
+            True,
+            'Can\'t find element matching "%s"' % selector,
+            timeout,
+        )
+
+    @traced
     def wait_while_selector(self, selector, timeout=None):
         """Waits until the selector no longer matches an element on the frame.
 
         :param selector: The selector to wait for.
         :param timeout: An optional timeout.
         """
-        self.wait_for(
-            lambda: not self.exists(selector),
+        self._wait_for_selector(
+            selector,
+            False,
             'Element matching "%s" is still available' % selector,
             timeout,
         )
         return True, self._release_last_resources()
 
-    def wait_for_text(self, text, timeout=None):
+    def wait_while_selector_async(self, selector, timeout=None):
+        """Non-blocking `wait_while_selector()`, returns a Future.
+
+        :param selector: The selector to wait for.
+        :param timeout: An optional timeout.
+        """
+        return self._wait_for_selector_async(
+            selector,
+            False,
+            'Element matching "%s" is still available' % selector,
+            timeout,
+        )
+
+    @traced
+    def wait_for_text(self, text, timeout=None, selector=None, regex=False,
+                      rendered=False):
         """Waits until given text appear on main frame.
 
+        The text is searched in page each time a MutationObserver reports
+        a change, without sending the document to Python: in the HTML of
+        the document, as `content` would have it, or with `rendered` in
+        the rendered text of the body only, which is cheaper on large
+        documents but ignores markup, attributes and hidden elements.
+
         :param text: The text to wait for.
         :param timeout: An optional timeout.
+        :param selector: An optional selector of the element to search in.
+        :param regex: Set to True to search text as a JavaScript regular
+            expression, which requires JavaScript to be enabled.
+        :param rendered: Set to True to search the rendered text only.
         """
-        self.wait_for(
-            lambda: text in self.content,
+        self._wait_for_dom(
+            self._text_predicate(text, selector, regex, rendered),
+            lambda: self._text_matches(text, selector, regex, rendered),
             'Can\'t find "%s" in current frame' % text,
             timeout,
+            'wait_for_text',
         )
         return True, self._release_last_resources()
 
+    def wait_for_text_async(self, text, timeout=None, selector=None,
+                            regex=False, rendered=False):
+        """Non-blocking `wait_for_text()`, returns a Future.
+
+        :param text: The text to wait for.
+        :param timeout: An optional timeout.
+        :param selector: An optional selector of the element to search in.
+        :param regex: Set to True to search text as a JavaScript regular
+            expression, which requires JavaScript to be enabled.
+        :param rendered: Set to True to search the rendered text only.
+        """
+        return self._wait_for_dom_async(
+            self._text_predicate(text, selector, regex, rendered),
+            lambda: self._text_matches(text, selector, regex, rendered),
+            'Can\'t find "%s" in current frame' % text,
+            timeout,
+            'wait_for_text',
+        )
+
+    def _text_predicate(self, text, selector, regex, rendered):
+        return """
+            function () {
+                var selector = %s, rendered = %s, regex = %s, search = %s,
+                    root, text;
+                if (selector) {
+                    root = document.querySelector(selector);
+                } else {
+                    root = rendered ? document.body : document.documentElement;
+                }
+                if (!root) {
+                    return false;
+                }
+                text = rendered ? root.innerText || root.textContent || '' :
+                    root.outerHTML;
+                return regex ? new RegExp(search).test(text) :
+                    text.indexOf(search) !== -1;
+            }
+        """ % (
+            json.dumps(selector or ''),
+            json.dumps(rendered),
+            json.dumps(regex),
+            json.dumps(text),
+        )
+
+    def _text_matches(self, text, selector, regex, rendered):
+        result = self._run_javascript(
+            self.main_frame,
+            '(%s)();' % self._text_predicate(text, selector, regex, rendered),
+        )
+        if result is not None:
+            return bool(result)
+        # JavaScript is unavailable, searches with the QtWebKit DOM API.
+        if regex:
+            raise Error('Waiting for a regular expression needs JavaScript')
+        if selector:
+            element = self.main_frame.findFirstElement(selector)
+            if element.isNull():
+                return False
+            return text in (
+                element.toPlainText() if rendered else element.toOuterXml())
+        return text in (
+            self.main_frame.toPlainText() if rendered else self.content)
+
+    def _selector_predicate(self, selector, present):
+        return """
+            function () {
+                return (document.querySelector(%s) !== null) === %s;
+            }
+        """ % (json.dumps(selector), json.dumps(present))
+
+    def _wait_for_selector(self, selector, present, timeout_message,
+                           timeout):
+        self._wait_for_dom(
+            self._selector_predicate(selector, present),
+            lambda: self.exists(selector) == present,
+            timeout_message,
+            timeout,
+            'wait_for_selector' if present else 'wait_while_selector',
+        )
+
+    def _wait_for_selector_async(self, selector, present, timeout_message,
+                                 timeout):
+        return self._wait_for_dom_async(
+            self._selector_predicate(selector, present),
+            lambda: self.exists(selector) == present,
+            timeout_message,
+            timeout,
+            'wait_for_selector' if present else 'wait_while_selector',
+        )
+
+    def _wait_for_dom(self, predicate, condition, timeout_message, timeout,
+                      name):
+        """Waits until condition is True. It is only checked when a
+        MutationObserver running the JavaScript predicate reports a match,
+        or on page events. Polling is used when no observer can be
+        injected.
+        """
+        observer_id = self._observe(predicate)
+        try:
+            self.wait_for(
+                condition,
+                timeout_message,
+                timeout,
+                poll=observer_id is None,
+                name=name,
+            )
+        finally:
+            self._disconnect_observer(observer_id)
+
+    def _wait_for_dom_async(self, predicate, condition, timeout_message,
+                            timeout, name):
+        observer_id = self._observe(predicate)
+        future = self.wait_for_async(
+            condition,
+            timeout_message,
+            timeout,
+            poll=observer_id is None,
+            result=lambda: (True, self._release_last_resources()),
+            name=name,
+        )
+        future.add_done_callback(
+            lambda future: self._disconnect_observer(observer_id))
+        return future
+
+    def _observe(self, predicate):
+        """Injects a MutationObserver that notifies the session whenever
+        the JavaScript predicate function returns true after a mutation,
+        until `_disconnect_observer()` is called.
+
+        :return: The observer id, or None if it couldn't be injected.
+        """
+        observer_id = next(self._observer_ids)
+        self._observers[observer_id] = predicate
+        if not self._install_observer(observer_id):
+            del self._observers[observer_id]
+            return None
+        return observer_id
+
+    def _install_observer(self, observer_id):
+        self.main_frame.addToJavaScriptWindowObject('ghostBridge',
+                                                    self._bridge)
+        return self._run_javascript(self.main_frame, """
+            (function (predicate, id) {
+                if (typeof MutationObserver === 'undefined' ||
+                        typeof ghostBridge === 'undefined') {
+                    return false;
+                }
+                // Stays attached until the wait is over, as the condition
+                // may be false again by the time it gets checked.
+                var observer = new MutationObserver(function () {
+                    if (predicate()) {
+                        ghostBridge.notify(id);
+                    }
+                });
+                window.ghostObservers = window.ghostObservers || {};
+                if (window.ghostObservers[id]) {
+                    window.ghostObservers[id].disconnect();
+                }
+                window.ghostObservers[id] = observer;
+                observer.observe(document, {
+                    childList: true,
+                    subtree: true,
+                    attributes: true,
+                    characterData: true
+                });
+                return true;
+            })(%s, %d);
+        """ % (self._observers[observer_id], observer_id))
+
+    def _disconnect_observer(self, observer_id):
+        if self._observers.pop(observer_id, None) is None:
+            return
+        self._run_javascript(self.main_frame, """
+            (function (id) {
+                var observer = window.ghostObservers &&
+                    window.ghostObservers[id];
+                if (observer) {
+                    observer.disconnect();
+                    delete window.ghostObservers[id];
+                }
+            })(%d);
+        """ % observer_id)
+
     def _authenticate(self, mix, authenticator):
         """Called back on basic / proxy http auth.
 
@@ -1224,12 +4293,18 @@ class Session(object):
         """Called back when page is loaded.
         """
         self.loaded = True
-        self.sleep()
+        self._settle_deadline = time.time() + self.settle_timeout
+        QTimer.singleShot(int(self.settle_timeout * 1000), self._wake_up)
+        for observer_id in self._observers:
+            # The new document needs its own observers.
+            self._install_observer(observer_id)
+        self._wake_up()
 
     def _page_load_started(self):
         """Called back when page load started.
         """
         self.loaded = False
+        self._page_waits = self._wait_totals()
 
     def _release_last_resources(self):
         """Releases last loaded resources.
@@ -1238,6 +4313,11 @@ class Session(object):
         """
         last_resources = self.http_resources
         self.http_resources = []
+        self.blocked_resources = []
+        self.released_resources += len(last_resources)
+        for resource in last_resources:
+            if resource._body is not None:
+                resource._body.release()
         return last_resources
 
     def _request_ended(self, reply):
@@ -1245,6 +4325,8 @@ class Session(object):
 
         :param reply: The QNetworkReply object.
         """
+        if self.metrics is not None:
+            self._record_request(reply)
 
         if reply.attribute(QNetworkRequest.HttpStatusCodeAttribute):
             self.logger.debug("[%s] bytesAvailable()= %s",
@@ -1252,15 +4334,53 @@ class Session(object):
                               reply.bytesAvailable())
 
             try:
-                content = reply.data
+                content = reply.body
             except AttributeError:
-                content = reply.readAll()
+                content = self.resource_policy.create_body(reply)
+                if content is not None:
+                    content.append(reply.readAll().data())
 
-            self.http_resources.append(HttpResource(
+            resource = HttpResource(
                 self,
                 reply,
                 content=content,
-            ))
+            )
+            if self.http_cache is not None:
+                self.http_cache.record(resource)
+            if resource.type in ('document', 'subframe'):
+                # Their web storage gets cleared on reset.
+                self._visit_origin(reply.url())
+            if self.har is not None and self.har.mode == 'record':
+                self.har.record(reply, resource)
+            self.http_resources.append(resource)
+        else:
+            body = getattr(reply, 'body', None)
+            if body is not None:
+                body.release()
+            if getattr(reply, 'blocked', False):
+                self.blocked_resources.append(
+                    HttpResource(self, reply, None))
+        self._wake_up()
+
+    def _record_request(self, reply):
+        metrics = self.metrics
+        metrics.add('requests_in_flight', -1)
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if status:
+            metrics.increment('responses_total', status=status)
+        elif getattr(reply, 'blocked', False):
+            metrics.increment('requests_blocked_total')
+        elif getattr(reply, 'replay_miss', False):
+            metrics.increment('requests_replay_missed_total')
+        else:
+            metrics.increment('requests_failed_total')
+        if reply.attribute(QNetworkRequest.SourceIsFromCacheAttribute):
+            metrics.increment('responses_from_cache_total')
+        metrics.increment(
+            'bytes_received_total', getattr(reply, 'bytes_received', 0))
+        started = getattr(reply, 'started', None)
+        if started is not None:
+            metrics.observe('request_seconds', time.time() - started)
 
     def _unsupported_content(self, reply):
         self.logger.info("Unsupported content %s",
@@ -1276,11 +4396,14 @@ class Session(object):
         :param reply: The QNetworkReply object.
         """
         if reply.attribute(QNetworkRequest.HttpStatusCodeAttribute):
+            content = ReplyBody()
+            content.append(reply.readAll().data())
             self.http_resources.append(HttpResource(
                 self,
                 reply,
-                reply.readAll(),
+                content,
             ))
+            self._wake_up()
 
     def _on_manager_ssl_errors(self, reply, errors):
         url = str(reply.url().toString())
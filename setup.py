@@ -27,6 +27,9 @@ setup(
     install_requires=[
         'xvfbwrapper==0.2.8',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Environment :: Web Environment',
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
+import time
 
 from flask import (
     abort,
@@ -97,6 +98,22 @@ def settimeout():
     return render_template('settimeout.html')
 
 
+@app.route('/late-asset')
+def late_asset():
+    # The script is requested once the page is loaded.
+    return (
+        '<html><body onload="var script = document.createElement(\'script\');'
+        ' script.src = \'%s\'; document.body.appendChild(script);">'
+        '</body></html>' % url_for('slow', delay=0.2)
+    )
+
+
+@app.route('/slow')
+def slow():
+    time.sleep(request.args.get('delay', 0.2, type=float))
+    return 'var slow = true;'
+
+
 @app.route('/items.json')
 def items():
     return jsonify(items=['second item', 'third item'])
@@ -141,10 +158,11 @@ def url_hash_header():
 
 @app.route('/many-assets')
 def many_assets():
+    count = request.args.get('count', 5, type=int)
     return render_template(
         'many_assets.html',
-        css=['css%s' % i for i in range(0, 5)],
-        js=['js%s' % i for i in range(0, 5)]
+        css=['css%s' % i for i in range(0, count)],
+        js=['js%s' % i for i in range(0, count)]
     )
 
 
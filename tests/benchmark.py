@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Times page loads of asset heavy pages.
+
+Usage: python tests/benchmark.py [asset count] [iterations]
+
+Prints the median, min and max load time of each case, for the record.
+CI runs it on /many-assets?count=150 in the docker/DockerfileTest image.
+"""
+import statistics
+import sys
+import time
+
+from ghost import Ghost, RequestScheduler
+from ghost.ghost import NetworkAccessManager
+from ghost.test import ServerThread
+
+from app import app
+
+
+PORT = 5001
+
+base_url = 'http://localhost:%s/' % PORT
+
+
+class SleepingNetworkAccessManager(NetworkAccessManager):
+    """Mimics the former blocking 1ms sleep per created request."""
+    def createRequest(self, operation, request, data):
+        reply = super(SleepingNetworkAccessManager, self).createRequest(
+            operation,
+            request,
+            data,
+        )
+        time.sleep(0.001)
+        return reply
+
+
+def bench(ghost, url, iterations, **kwargs):
+    timings = []
+    with ghost.start(**kwargs) as session:
+        for _ in range(iterations):
+            started_at = time.time()
+            session.open(url)
+            timings.append(time.time() - started_at)
+    return timings
+
+
+def main(count=150, iterations=5):
+    server = ServerThread(app, PORT)
+    server.daemon = True
+    server.start()
+    while not hasattr(server, 'http_server'):
+        time.sleep(0.01)
+
+    url = '%smany-assets?count=%s' % (base_url, count)
+    ghost = Ghost()
+    cases = [
+        ('blocking createRequest', dict(
+            network_access_manager_class=SleepingNetworkAccessManager,
+        )),
+        ('non-blocking createRequest', dict()),
+        ('scheduler, 4 per host', dict(
+            request_scheduler=RequestScheduler(max_per_host=4),
+        )),
+    ]
+    print('%s, %s iterations' % (url, iterations))
+    print('%-30s %8s %8s %8s' % ('case', 'median', 'min', 'max'))
+    try:
+        for name, kwargs in cases:
+            timings = bench(ghost, url, iterations, **kwargs)
+            print('%-30s %7.3fs %7.3fs %7.3fs' % (
+                name,
+                statistics.median(timings),
+                min(timings),
+                max(timings),
+            ))
+    finally:
+        server.join()
+        ghost.exit()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
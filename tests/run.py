@@ -1,13 +1,42 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import gc
 import os
+import asyncio
 import json
+import shutil
+import tempfile
+import time
 import unittest
 
 from http import cookiejar
 
-from ghost import GhostTestCase
-from ghost.ghost import default_user_agent
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ghost import (
+    AsyncGhost,
+    Blocklist,
+    CannedResponse,
+    Error,
+    HarArchive,
+    HttpCache,
+    GhostFarm,
+    Metrics,
+    GhostTestCase,
+    RequestScheduler,
+    ResourcePolicy,
+    TimeoutError,
+    Tracer,
+    WorkerError,
+    stitch_tiles,
+)
+from ghost.ghost import default_user_agent, NetworkAccessManager, ReplyBody
+from PySide2.QtCore import QByteArray, QPoint, QUrl
+from PySide2.QtGui import QColor, QImage
+from PySide2.QtNetwork import QNetworkCacheMetaData, QNetworkRequest
 
 from app import app
 
@@ -17,6 +46,21 @@ PORT = 5000
 base_url = 'http://localhost:%s/' % PORT
 
 
+def crash(session):
+    os._exit(1)
+
+
+def unpicklable(session):
+    return lambda: None
+
+
+class LegacyNetworkAccessManager(NetworkAccessManager):
+    """Subclass written for the former constructor signature."""
+    def __init__(self, exclude_regex=None, *args, **kwargs):
+        super(LegacyNetworkAccessManager, self).__init__(
+            exclude_regex, *args, **kwargs)
+
+
 class GhostTest(GhostTestCase):
     port = PORT
     display = False
@@ -58,6 +102,137 @@ class GhostTest(GhostTestCase):
             bytes,
         )
 
+    def test_extra_resource_body(self):
+        page, resources = self.session.open(base_url)
+        body = resources[4].body
+        self.assertIsInstance(body, memoryview)
+        self.assertEqual(body.tobytes(), resources[4].content)
+
+    def test_reply_body_spill(self):
+        body = ReplyBody(max_memory=4)
+        body.append(b'ab')
+        self.assertIsNone(body._file)
+        body.append(b'cdef')
+        self.assertIsNotNone(body._file)
+        self.assertEqual(body.size, 6)
+        self.assertEqual(body.view().tobytes(), b'abcdef')
+
+    def test_resource_policy_total_memory(self):
+        policy = ResourcePolicy(max_total_memory=4)
+        first = ReplyBody(policy=policy)
+        second = ReplyBody(policy=policy)
+        first.append(b'abc')
+        second.append(b'ab')
+        self.assertIsNone(first._file)
+        self.assertIsNotNone(second._file)
+        self.assertEqual(policy.memory_used, 3)
+        first.append(b'd')
+        self.assertEqual(policy.memory_used, 4)
+        second.release()
+        self.assertEqual(policy.memory_used, 4)
+        first.release()
+        self.assertEqual(policy.memory_used, 0)
+        dropped = ReplyBody(policy=policy)
+        dropped.append(b'abcd')
+        dropped.release()
+        self.assertEqual(policy.memory_used, 0)
+
+    def test_resource_policy_shared_by_sessions(self):
+        policy = ResourcePolicy(max_total_memory=1024 * 1024)
+        first = self.ghost.start(resource_policy=policy)
+        second = self.ghost.start(resource_policy=policy)
+        first.open(base_url)
+        self.assertEqual(policy.memory_used, 0)
+        # The second session's bodies stay reserved until it releases
+        # them, whatever the first one does.
+        second.main_frame.load(QUrl(base_url))
+        second.wait_for(lambda: second.loaded, 'Not loaded')
+        second.sleep(0.5)
+        used = policy.memory_used
+        self.assertGreater(used, 0)
+        first.open(base_url)
+        self.assertGreaterEqual(policy.memory_used, used)
+        second.evaluate('1')
+        self.assertEqual(policy.memory_used, 0)
+        first.exit()
+        second.exit()
+
+    def test_resource_policy_headers_only(self):
+        session = self.ghost.start(
+            resource_policy=ResourcePolicy(keep_bodies=False),
+        )
+        page, resources = session.open(base_url)
+        self.assertIn(b'Ghost.py', page.content)
+        self.assertIsNone(resources[4].content)
+        session.exit()
+
+    def test_resource_policy_mime_types(self):
+        session = self.ghost.start(
+            resource_policy=ResourcePolicy(mime_types='javascript'),
+        )
+        page, resources = session.open(base_url)
+        self.assertIn(b'globals alert', resources[4].content)
+        self.assertIsNone(resources[5].content)
+        session.exit()
+
+    def test_http_cache(self):
+        directory = tempfile.mkdtemp()
+        cache = HttpCache(directory)
+        try:
+            for _ in range(2):
+                session = self.ghost.start(http_cache=cache)
+                page, resources = session.open(base_url)
+                session.exit()
+            styles = [r for r in resources if r.url.endswith('styles.css')]
+            self.assertTrue(styles[0].from_cache)
+            self.assertGreater(cache.hits, 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_disk_cache_evicts_least_recently_read(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = HttpCache(directory, max_size=350 * 1024).create()
+
+        def insert(name, cache=cache):
+            meta_data = QNetworkCacheMetaData()
+            meta_data.setUrl(QUrl('http://example.com/%s' % name))
+            meta_data.setSaveToDisk(True)
+            # Text entries are stored compressed, and read from memory.
+            meta_data.setRawHeaders([(
+                QByteArray(b'Content-Type'),
+                QByteArray(b'text/html'),
+            )])
+            device = cache.prepare(meta_data)
+            device.write(os.urandom(100 * 1024))
+            cache.insert(device)
+
+        for name in ('a', 'b', 'c'):
+            insert(name)
+        now = time.time()
+        ages = {'a': 300, 'b': 200, 'c': 100}
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                url = cache.fileMetaData(path).url().toString()
+                age = ages[url.rsplit('/', 1)[-1]]
+                os.utime(path, (now - age, now - age))
+
+        self.assertIsNotNone(cache.data(QUrl('http://example.com/a')))
+        insert('d')
+        self.assertTrue(
+            cache.metaData(QUrl('http://example.com/a')).isValid())
+        self.assertFalse(
+            cache.metaData(QUrl('http://example.com/b')).isValid())
+
+        # The read of 'a' is shared with other caches through the index.
+        other = HttpCache(directory, max_size=350 * 1024).create()
+        insert('e', other)
+        self.assertTrue(
+            other.metaData(QUrl('http://example.com/a')).isValid())
+        self.assertFalse(
+            other.metaData(QUrl('http://example.com/c')).isValid())
+
     def test_wait_for_selector(self):
         page, resources = self.session.open(base_url)
         success, resources = self.session.click("#update-list-button")
@@ -65,6 +240,49 @@ class GhostTest(GhostTestCase):
             .wait_for_selector("#list li:nth-child(2)")
         self.assertEqual(resources[0].url, "%sitems.json" % base_url)
 
+    def test_wait_for_selector_without_polling(self):
+        session = self.ghost.start(wait_poll_interval=60)
+        session.open(base_url)
+        session.click("#update-list-button")
+        started_at = time.time()
+        success, resources = session.wait_for_selector("#list li:nth-child(2)")
+        self.assertLess(time.time() - started_at, 5)
+        self.assertEqual(session._observers, {})
+        session.exit()
+
+    def test_wait_for_selector_flashing_node(self):
+        session = self.ghost.start(wait_poll_interval=60)
+        session.open(base_url)
+        # The first #flash node is removed right after the session got
+        # notified, the second one stays.
+        session.evaluate("""
+            window.setTimeout(function () {
+                new MutationObserver(function (mutations, observer) {
+                    observer.disconnect();
+                    document.getElementById('flash').remove();
+                }).observe(document.body, {childList: true});
+                var flash = document.createElement('p');
+                flash.id = 'flash';
+                document.body.appendChild(flash);
+            }, 100);
+            window.setTimeout(function () {
+                var flash = document.createElement('p');
+                flash.id = 'flash';
+                document.body.appendChild(flash);
+            }, 400);
+        """)
+        success, resources = session.wait_for_selector('#flash', timeout=5)
+        self.assertTrue(session.exists('#flash'))
+        session.exit()
+
+    def test_wait_while_selector(self):
+        self.session.open(base_url)
+        self.session.evaluate(
+            "window.setTimeout(function () {"
+            " document.querySelector('h1').remove(); }, 200);")
+        success, resources = self.session.wait_while_selector('h1')
+        self.assertFalse(self.session.exists('h1'))
+
     def test_sleep(self):
         page, resources = self.session.open("%s" % base_url)
         result, _ = self.session.evaluate("window.result")
@@ -78,10 +296,164 @@ class GhostTest(GhostTestCase):
         self.session.click("#update-list-button")
         success, resources = self.session.wait_for_text("second item")
 
+    def test_wait_for_text_in_selector(self):
+        self.session.open(base_url)
+        self.session.click("#update-list-button")
+        success, resources = self.session.wait_for_text(
+            "third item",
+            selector="#list",
+        )
+        self.assertTrue(success)
+        self.assertRaises(
+            TimeoutError,
+            self.session.wait_for_text,
+            "third item",
+            selector="h1",
+            timeout=0.5,
+        )
+
+    def test_wait_for_text_regex(self):
+        self.session.open(base_url)
+        self.session.click("#update-list-button")
+        success, resources = self.session.wait_for_text(
+            "(second|third) item",
+            regex=True,
+        )
+        self.assertTrue(success)
+
+    def test_wait_for_text_in_markup(self):
+        self.session.open(base_url)
+        success, resources = self.session.wait_for_text('update-list-button')
+        self.assertTrue(success)
+        self.assertRaises(
+            TimeoutError,
+            self.session.wait_for_text,
+            'update-list-button',
+            rendered=True,
+            timeout=0.5,
+        )
+
+    def test_wait_for_text_rendered(self):
+        self.session.open(base_url)
+        self.session.click("#update-list-button")
+        success, resources = self.session.wait_for_text(
+            "second item",
+            rendered=True,
+        )
+        self.assertTrue(success)
+
     def test_wait_for_timeout(self):
         self.session.open("%s" % base_url)
         self.assertRaises(Exception, self.session.wait_for_text, "undefined")
 
+    def test_wait_for_event_timeout(self):
+        self.session.open(base_url)
+        started_at = time.time()
+        self.assertRaises(
+            TimeoutError,
+            self.session.wait_for,
+            lambda: False,
+            'never',
+            timeout=0.5,
+            poll=False,
+        )
+        self.assertLess(time.time() - started_at, 1)
+
+    def test_wait_for_alert_wakes_up(self):
+        self.session.open(base_url)
+        self.session.evaluate(
+            "window.setTimeout(function () { alert('late'); }, 200);")
+        started_at = time.time()
+        msg, resources = self.session.wait_for_alert()
+        self.assertEqual(msg, 'late')
+        self.assertLess(time.time() - started_at, 1)
+
+    def test_wait_for_alert_async_checked_from_event_loop(self):
+        self.session.open(base_url)
+        future = self.session.wait_for_alert_async()
+        self.session.evaluate("alert('now');")
+        # Not resolved from within the dialog.
+        self.assertFalse(future.done())
+        msg, resources = self.ghost.wait([future])[0]
+        self.assertEqual(msg, 'now')
+
+    def test_open_async(self):
+        first = self.ghost.start()
+        second = self.ghost.start()
+        (page, _), (other, _) = self.ghost.wait([
+            first.open_async(base_url),
+            second.open_async("%sno-cache" % base_url),
+        ])
+        self.assertEqual(page.url, base_url)
+        self.assertIn(b"cache for me", other.content)
+        first.exit()
+        second.exit()
+
+    def test_open_waits_for_late_resources(self):
+        page, resources = self.session.open("%slate-asset" % base_url)
+        self.assertIn(
+            "%sslow?delay=0.2" % base_url,
+            [resource.url for resource in resources],
+        )
+
+    def test_exit_fails_pending_waits(self):
+        session = self.ghost.start()
+        session.open(base_url)
+        future = session.wait_for_selector_async('#missing')
+        session.exit()
+        self.assertTrue(future.done())
+        self.assertRaises(Error, future.result)
+
+    def test_wait_for_selector_async(self):
+        self.session.open(base_url)
+        self.session.click("#update-list-button")
+        future = self.session.wait_for_selector_async("#list li:nth-child(2)")
+        success, resources = self.ghost.wait([future])[0]
+        self.assertEqual(resources[0].url, "%sitems.json" % base_url)
+
+    def test_wait_for_async_timeout(self):
+        self.session.open(base_url)
+        future = self.session.wait_for_text_async("undefined", timeout=0.5)
+        self.assertRaises(TimeoutError, self.ghost.wait, [future])
+
+    def test_asyncio_gather(self):
+        aghost = AsyncGhost(self.ghost)
+
+        async def fetch(url, text):
+            async with aghost.start() as session:
+                page, resources = await session.open(url)
+                await session.wait_for_text(text)
+                value, _ = await session.evaluate('document.title || "ok"')
+                return page.http_status, value
+
+        results = asyncio.get_event_loop().run_until_complete(
+            asyncio.gather(
+                fetch(base_url, 'Ghost.py'),
+                fetch("%sno-cache" % base_url, 'cache for me'),
+            )
+        )
+        self.assertEqual(results, [(200, 'ok'), (200, 'ok')])
+
+    def test_asyncio_exit_does_not_block(self):
+        aghost = AsyncGhost(self.ghost)
+        session = aghost.start()
+        ticks = []
+
+        async def tick():
+            for _ in range(5):
+                ticks.append(time.time())
+                await asyncio.sleep(0.01)
+
+        async def exit():
+            started_at = time.time()
+            await session.exit()
+            return started_at
+
+        started_at, _ = asyncio.get_event_loop().run_until_complete(
+            asyncio.gather(exit(), tick()))
+        self.assertGreaterEqual(len([t for t in ticks if t > started_at]), 3)
+        self.assertFalse(hasattr(session.session, 'webview'))
+
     def test_fill(self):
         self.session.open(base_url)
         values = {
@@ -110,6 +482,25 @@ class GhostTest(GhostTestCase):
             'document.getElementById("radio-second").checked')
         self.assertEqual(value, False)
 
+    def test_fill_fires_events(self):
+        self.session.open(base_url)
+        self.session.evaluate('''
+            window.events = [];
+            ['input', 'change', 'blur'].forEach(function (name) {
+                document.getElementById('text').addEventListener(
+                    name,
+                    function () { window.events.push(name); }
+                );
+            });
+        ''')
+        self.session.fill('form', {'text': 'sample'})
+        value, resources = self.session.evaluate('window.events.join()')
+        self.assertEqual(value, 'input,change,blur')
+
+    def test_fill_missing_field(self):
+        self.session.open(base_url)
+        self.assertRaises(Error, self.session.fill, 'form', {'missing': 1})
+
     def test_form_submission(self):
         self.session.open(base_url)
         values = {
@@ -240,6 +631,97 @@ class GhostTest(GhostTestCase):
         self.assertTrue(os.path.isfile('test.png'))
         os.remove('test.png')
 
+    def test_capture_tiles(self):
+        self.session.open(base_url)
+        viewport_size = self.session.page.viewportSize()
+        size = self.session.main_frame.contentsSize()
+        tiles = list(self.session.capture_tiles(tile_size=(200, 300)))
+        self.assertEqual(self.session.page.viewportSize(), viewport_size)
+        self.assertEqual(tiles[0][:2], (0, 0))
+        for x, y, tile in tiles:
+            self.assertLessEqual(tile.width(), 200)
+            self.assertLessEqual(tile.height(), 300)
+        image = stitch_tiles(tiles)
+        self.assertEqual(
+            (image.width(), image.height()),
+            (size.width(), size.height()),
+        )
+
+    def test_capture_tiles_to(self):
+        self.session.open(base_url)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        tiles = self.session.capture_tiles_to(
+            directory,
+            tile_size=(100, 100),
+            selector='h1',
+        )
+        self.assertEqual(len(tiles), 3)
+        self.assertTrue(all(os.path.isfile(path) for _, _, path in tiles))
+        image = stitch_tiles(tiles)
+        self.assertEqual((image.width(), image.height()), (299, 39))
+
+    def test_capture_to_async(self):
+        self.session.open(base_url)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        futures = [
+            self.session.capture_to_async(
+                os.path.join(directory, 'capture.jpg'), quality=50),
+            self.session.capture_to_async(
+                os.path.join(directory, 'capture.png'), compression=9),
+        ]
+        paths = self.ghost.wait(futures, timeout=10)
+        self.assertTrue(all(os.path.isfile(path) for path in paths))
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(f.read(3), b'\xff\xd8\xff')
+
+    def test_image_encoder_encode(self):
+        self.session.open(base_url)
+        image = self.session.capture(selector='h1')
+        data = self.ghost.image_encoder.encode(image, 'png').result()
+        self.assertTrue(data.startswith(b'\x89PNG'))
+
+    def test_image_encoder_png_compression(self):
+        self.session.open(base_url)
+        image = self.session.capture()
+        sizes = [
+            len(self.ghost.image_encoder.encode(
+                image, 'png', compression=level).result())
+            for level in (0, 1, 9)
+        ]
+        self.assertGreater(sizes[0], sizes[1])
+        self.assertGreater(sizes[1], sizes[2])
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_capture_array(self):
+        self.session.open(base_url)
+        array = self.session.capture_array(selector='h1')
+        self.assertEqual(array.shape, (39, 299, 4))
+        self.assertEqual(array.dtype, numpy.uint8)
+        image = self.session.capture(
+            selector='h1',
+            format=QImage.Format_RGBA8888,
+        )
+        color = QColor(image.pixel(5, 5))
+        self.assertEqual(
+            tuple(array[5, 5]),
+            (color.red(), color.green(), color.blue(), color.alpha()),
+        )
+        # The array is a view on the captured image, which it keeps alive.
+        image = array.base.image
+        array[5, 5] = (10, 20, 30, 255)
+        self.assertEqual(QColor(image.pixel(5, 5)).getRgb(), (10, 20, 30, 255))
+        del image
+        gc.collect()
+        garbage = []
+        for _ in range(8):
+            other = QImage(299, 39, QImage.Format_RGBA8888)
+            other.fill(0)
+            garbage.append(other)
+        self.assertEqual(tuple(array[5, 5]), (10, 20, 30, 255))
+        array[:] = 0
+
     def test_region_for_selector(self):
         self.session.open(base_url)
         x1, y1, x2, y2 = self.session.region_for_selector('h1')
@@ -248,12 +730,107 @@ class GhostTest(GhostTestCase):
         self.assertEqual(x2, 329)
         self.assertEqual(y2, 59)
 
+    def test_query_many(self):
+        self.session.open(base_url)
+        result = self.session.query_many({
+            'title': 'h1',
+            'missing': '#missing',
+            'inputs': {'selector': 'input', 'count': True},
+            'radios': {
+                'selector': '[name=radio]',
+                'all': True,
+                'text': False,
+                'attributes': ['value'],
+            },
+            'heading': {'selector': 'h1', 'region': True, 'text': False},
+        })
+        self.assertEqual(result['title'], {'text': 'Ghost.py'})
+        self.assertIsNone(result['missing'])
+        self.assertEqual(result['inputs'], 9)
+        self.assertEqual(
+            [r['attributes']['value'] for r in result['radios']],
+            ['first choice', 'second choice'],
+        )
+        self.assertEqual(
+            result['heading']['region'],
+            self.session.region_for_selector('h1'),
+        )
+
     def test_capture_selector_to(self):
         self.session.open(base_url)
         self.session.capture_to('test.png', selector='h1')
         self.assertTrue(os.path.isfile('test.png'))
         os.remove('test.png')
 
+    def test_capture_selector(self):
+        session = self.ghost.start(viewport_size=(800, 600))
+        session.open(base_url)
+        image = session.capture(selector='h1')
+        self.assertEqual((image.width(), image.height()), (299, 39))
+        self.assertEqual(session.page.viewportSize().height(), 600)
+        session.exit()
+
+    def test_capture_region_beyond_viewport(self):
+        session = self.ghost.start(viewport_size=(200, 100))
+        session.open(base_url)
+        image = session.capture(region=(10, 50, 310, 250))
+        self.assertEqual((image.width(), image.height()), (300, 200))
+        self.assertEqual(session.page.viewportSize().width(), 200)
+        session.exit()
+
+    def test_capture_region_below_the_fold(self):
+        session = self.ghost.start(viewport_size=(200, 100))
+        session.open(base_url)
+        region = (0, 300, 100, 350)
+        session.main_frame.setScrollPosition(QPoint(0, 300))
+        expected = session.capture(region=region)
+        session.main_frame.setScrollPosition(QPoint(0, 20))
+        image = session.capture(region=region)
+        self.assertEqual((image.width(), image.height()), (100, 50))
+        self.assertEqual(image, expected)
+        self.assertEqual(session.main_frame.scrollPosition(), QPoint(0, 20))
+        self.assertEqual(session.page.viewportSize().height(), 100)
+        session.exit()
+
+    def test_capture_many(self):
+        self.session.open(base_url)
+        images = self.session.capture_many({
+            'heading': 'h1',
+            'missing': '#missing',
+        })
+        self.assertEqual(
+            (images['heading'].width(), images['heading'].height()),
+            (299, 39),
+        )
+        self.assertIsNone(images['missing'])
+
+    def test_capture_many_to_directory(self):
+        self.session.open(base_url)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        paths = self.session.capture_many(
+            ['h1', 'form'],
+            directory=directory,
+            compression=1,
+        )
+        self.assertEqual(paths['h1'], os.path.join(directory, 'h1.png'))
+        self.assertTrue(all(os.path.isfile(p) for p in paths.values()))
+
+    def test_capture_many_file_name_collisions(self):
+        self.session.open(base_url)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        paths = self.session.capture_many(
+            {'ul > li': 'h1', 'ul li': 'h1', 'ul  li': 'h1'},
+            directory=directory,
+        )
+        self.assertEqual(paths['ul  li'], os.path.join(directory, 'ul_li.png'))
+        self.assertEqual(
+            paths['ul > li'], os.path.join(directory, 'ul_li-2.png'))
+        self.assertEqual(
+            paths['ul li'], os.path.join(directory, 'ul_li-3.png'))
+        self.assertEqual(len(os.listdir(directory)), 3)
+
     def test_set_field_value_checkbox_true(self):
         self.session.open(base_url)
         self.session.set_field_value('[name=checkbox]', True)
@@ -390,6 +967,15 @@ class GhostTest(GhostTestCase):
         page, resources = self.session.open("%smany-assets" % base_url)
         page, resources = self.session.open("%smany-assets" % base_url)
 
+    def test_request_scheduler(self):
+        scheduler = RequestScheduler(max_per_host=2, max_rate=100)
+        session = self.ghost.start(request_scheduler=scheduler)
+        page, resources = session.open("%smany-assets" % base_url)
+        self.assertEqual(page.http_status, 200)
+        self.assertEqual(len(resources), 11)
+        self.assertTrue(all(r.http_status == 200 for r in resources))
+        session.exit()
+
     def test_frame_ascend(self):
         session = self.session
         session.open(base_url)
@@ -454,6 +1040,343 @@ class GhostTest(GhostTestCase):
             "%sstatic/blackhat.jpg" % base_url in url_loaded)
         session.exit()
 
+    def test_resource_timings(self):
+        page, resources = self.session.open(base_url)
+        for resource in resources:
+            self.assertFalse(resource.blocked)
+            self.assertLessEqual(resource.started, resource.first_byte)
+            self.assertLessEqual(resource.first_byte, resource.finished)
+        self.assertEqual(page.bytes_received, len(page.content))
+        waterfall = self.session.waterfall
+        self.assertEqual(len(waterfall.resources), len(resources))
+        self.assertIn(page.url, str(waterfall))
+        self.assertEqual(
+            waterfall.by_host()['localhost']['requests'],
+            len(resources),
+        )
+
+    def test_waterfall_blocked(self):
+        session = self.ghost.start(exclude="\\.jpg")
+        session.open(base_url)
+        blocked = [r for r in session.waterfall.resources if r.blocked]
+        self.assertEqual(
+            [r.url for r in blocked],
+            ["%sstatic/blackhat.jpg" % base_url],
+        )
+        self.assertIsNone(blocked[0].http_status)
+        session.exit()
+
+    def test_page_metrics(self):
+        page, resources = self.session.open(base_url)
+        metrics = self.session.page_metrics()
+        self.assertEqual(
+            sum(c['requests'] for c in metrics['resources'].values()),
+            len(resources),
+        )
+        self.assertEqual(metrics['resources']['document']['requests'], 1)
+        self.assertEqual(metrics['resources']['subframe']['requests'], 2)
+        self.assertGreater(metrics['ghost']['wait'], 0)
+        self.assertLessEqual(
+            metrics['ghost']['idle'],
+            metrics['ghost']['wait'],
+        )
+        self.assertLessEqual(
+            metrics['ghost']['wait'], self.session.wait_time)
+        self.session.sleep(0.2)
+        self.session.open(base_url)
+        second = self.session.page_metrics()
+        self.assertLess(
+            second['ghost']['wait'], self.session.wait_time - 0.2)
+        if metrics['navigation'] is not None:
+            self.assertLessEqual(
+                metrics['navigation']['ttfb'],
+                metrics['navigation']['load'],
+            )
+
+    def test_metrics(self):
+        metrics = Metrics()
+        self.ghost.metrics = metrics
+        try:
+            session = self.ghost.start()
+            page, resources = session.open(base_url)
+            with self.assertRaises(TimeoutError):
+                session.wait_for_selector('#missing', timeout=0.1)
+            session.capture()
+            session.exit()
+        finally:
+            self.ghost.metrics = None
+
+        self.assertEqual(metrics.gauges['sessions', ()], 0)
+        self.assertEqual(metrics.gauges['requests_in_flight', ()], 0)
+        self.assertGreaterEqual(
+            sum(
+                value for (name, _), value in metrics.counters.items()
+                if name == 'responses_total'
+            ),
+            len(resources),
+        )
+        self.assertEqual(
+            metrics.counters[
+                'wait_timeouts_total', (('wait', 'wait_for_selector'),)],
+            1,
+        )
+        exposition = metrics.exposition()
+        self.assertIn('# TYPE ghost_wait_seconds histogram', exposition)
+        self.assertIn(
+            'ghost_wait_seconds_count{wait="wait_for_page_loaded"} 1',
+            exposition,
+        )
+        self.assertIn('ghost_capture_seconds_count 1', exposition)
+
+    def test_tracer(self):
+        tracer = Tracer()
+        session = self.ghost.start(tracer=tracer)
+        session.open(base_url)
+        session.evaluate('document.title;')
+        session.click('h1')
+        session.capture()
+        session.exit()
+
+        names = [span['name'] for span in tracer.spans]
+        self.assertEqual(
+            names,
+            ['wait_for_page_loaded', 'open', 'evaluate', 'click', 'capture'],
+        )
+        open_span = tracer.spans[1]
+        self.assertGreater(open_span['resources'], 0)
+        self.assertLessEqual(open_span['event_loop'], open_span['duration'])
+        self.assertGreater(tracer.spans[2]['javascript'], 0)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'trace.json')
+        tracer.save(path)
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual(len(events), 5)
+        self.assertEqual(events[1]['ph'], 'X')
+
+    def test_reset(self):
+        session = self.session
+        session.open("%scookie" % base_url)
+        session.open(base_url)
+        session.evaluate("localStorage.setItem('foo', 'bar');")
+        session.frame('first-frame')
+        session.reset()
+        self.assertEqual(len(session.cookies), 0)
+        self.assertEqual(session.http_resources, [])
+        self.assertEqual(session.main_frame, session.page.mainFrame())
+        self.assertEqual(session.main_frame.url().toString(), 'about:blank')
+
+    def test_reset_clears_visited_origins_storage(self):
+        session = self.ghost.start()
+        other_url = base_url.replace('localhost', '127.0.0.1')
+        session.open(base_url)
+        session.evaluate(
+            "localStorage.setItem('foo', 'bar');"
+            " sessionStorage.setItem('foo', 'bar');")
+        session.open(other_url)
+        session.reset()
+        session.open(base_url)
+        self.assertIsNone(
+            session.evaluate("localStorage.getItem('foo');")[0])
+        self.assertIsNone(
+            session.evaluate("sessionStorage.getItem('foo');")[0])
+        session.exit()
+
+    def test_session_pool_disables_local_storage(self):
+        pool = self.ghost.pool(max_size=1)
+        with pool.session() as session:
+            session.open(base_url)
+            self.assertTrue(
+                session.evaluate("window.localStorage === null;")[0])
+        pool.close()
+
+    def test_session_pool(self):
+        pool = self.ghost.pool(max_size=1)
+        with pool.session() as session:
+            session.open("%scookie" % base_url)
+            self.assertRaises(Error, pool.checkout)
+        with pool.session() as reused:
+            self.assertIs(reused, session)
+            self.assertEqual(len(reused.cookies), 0)
+        pool.close()
+        self.assertEqual(len(pool), 0)
+
+    def test_session_pool_eviction(self):
+        pool = self.ghost.pool(max_idle=0)
+        session = pool.checkout()
+        pool.checkin(session)
+        self.assertEqual(len(pool), 0)
+
+    def test_farm(self):
+        with GhostFarm(workers=1, max_jobs=1) as farm:
+            first = farm.fetch(base_url, selector='h1', resources=True)
+            second = farm.fetch("%sno-cache" % base_url)
+            result = first.result(timeout=30)
+            self.assertEqual(result['http_status'], 200)
+            self.assertIn('Ghost.py', result['content'])
+            self.assertEqual(result['resources'][0]['url'], base_url)
+            self.assertIn('cache for me', second.result(timeout=30)['content'])
+
+    def test_farm_worker_crash(self):
+        with GhostFarm(workers=1) as farm:
+            self.assertRaises(
+                WorkerError,
+                farm.submit(crash).result,
+                timeout=30,
+            )
+            self.assertIn(
+                'cache for me',
+                farm.fetch("%sno-cache" % base_url).result(timeout=30)[
+                    'content'],
+            )
+
+    def test_farm_unpicklable(self):
+        with GhostFarm(workers=1) as farm:
+            self.assertRaises(
+                WorkerError,
+                farm.submit(unpicklable).result,
+                timeout=30,
+            )
+            self.assertRaises(
+                WorkerError,
+                farm.submit(crash, lambda: None).result,
+                timeout=1,
+            )
+
+    def test_farm_worker_start_failure(self):
+        with GhostFarm(
+            workers=1,
+            max_start_failures=2,
+            ghost_kwargs={'unknown': True},
+        ) as farm:
+            future = farm.fetch(base_url)
+            self.assertRaises(WorkerError, future.result, timeout=60)
+            self.assertRaises(
+                WorkerError,
+                farm.fetch(base_url).result,
+                timeout=1,
+            )
+
+    def test_blocklist(self):
+        blocklist = Blocklist([
+            '! comment',
+            '/static/*.jpg|',
+            '||localhost^*.css$stylesheet',
+            '@@/static/styles.css',
+        ])
+        session = self.ghost.start(interceptors=[blocklist])
+        page, resources = session.open(base_url)
+        urls = [r.url for r in resources]
+        self.assertNotIn("%sstatic/blackhat.jpg" % base_url, urls)
+        self.assertIn("%sstatic/styles.css" % base_url, urls)
+        self.assertEqual(dict(blocklist.hits), {'/static/*.jpg|': 1})
+        self.assertEqual(blocklist.skipped, 1)
+        session.exit()
+
+    def test_blocklist_domain_prefix(self):
+        blocklist = Blocklist(['||ads.example^', '||track.example'])
+
+        def blocked(url):
+            return blocklist(None, QNetworkRequest(QUrl(url))) is False
+
+        self.assertTrue(blocked('http://ads.example/banner.js'))
+        self.assertTrue(blocked('http://cdn.ads.example/banner.js'))
+        self.assertFalse(blocked('http://ads.example.org/banner.js'))
+        self.assertTrue(blocked('http://track.example/pixel.gif'))
+        self.assertTrue(blocked('http://track.example.org/pixel.gif'))
+        self.assertFalse(blocked('http://example.org/track.example'))
+
+    def test_legacy_network_access_manager(self):
+        blocklist = Blocklist(['/static/*.jpg|'])
+        session = self.ghost.start(
+            network_access_manager_class=LegacyNetworkAccessManager,
+            interceptors=[blocklist],
+        )
+        page, resources = session.open(base_url)
+        self.assertEqual(page.http_status, 200)
+        self.assertEqual(dict(blocklist.hits), {'/static/*.jpg|': 1})
+        session.exit()
+
+    def test_interceptors(self):
+        def rewrite(operation, request):
+            if request.url().path() == '/echo/rewritten':
+                request.setUrl(QUrl("%secho/target" % base_url))
+
+        def canned(operation, request):
+            if request.url().path() == '/canned':
+                return CannedResponse(
+                    b'<p>canned</p>',
+                    headers={'Content-Type': 'text/html'},
+                )
+
+        session = self.ghost.start(interceptors=[rewrite, canned])
+        page, resources = session.open("%scanned" % base_url)
+        self.assertEqual(page.http_status, 200)
+        self.assertEqual(page.content, b'<p>canned</p>')
+        page, resources = session.open("%secho/rewritten" % base_url)
+        self.assertIn('target', session.content)
+        session.exit()
+
+    def test_loading_profile_text_only(self):
+        session = self.ghost.start(loading_profile='text-only')
+        page, resources = session.open(base_url)
+        urls = [r.url for r in resources]
+        self.assertEqual(page.url, base_url)
+        self.assertIn("%sstatic/app.js" % base_url, urls)
+        self.assertNotIn("%sstatic/styles.css" % base_url, urls)
+        self.assertNotIn("%sstatic/blackhat.jpg" % base_url, urls)
+        self.assertNotIn("%secho/frame%%201" % base_url, urls)
+        self.assertEqual(session.loading_profile.blocked['subframe'], 2)
+        session.exit()
+
+    def test_loading_profile_no_media(self):
+        session = self.ghost.start(loading_profile='no-media')
+        page, resources = session.open(base_url)
+        urls = [r.url for r in resources]
+        self.assertIn("%sstatic/styles.css" % base_url, urls)
+        self.assertNotIn("%sstatic/blackhat.jpg" % base_url, urls)
+        session.exit()
+
+    def test_har_record_and_replay(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'session.har')
+
+        har = HarArchive(path, mode='record')
+        session = self.ghost.start(
+            har=har,
+            resource_policy=ResourcePolicy(keep_bodies=False),
+        )
+        session.open(base_url)
+        page, resources = session.open("%secho/recorded" % base_url)
+        session.exit()
+        self.assertTrue(os.path.exists(path))
+        entries = dict(
+            (entry['request']['url'], entry) for entry in har.entries)
+        self.assertIn("%secho/recorded" % base_url, entries)
+        # Recorded even though the resource policy drops bodies.
+        self.assertIn(
+            'color',
+            entries["%sstatic/styles.css" % base_url]['response'][
+                'content']['text'],
+        )
+
+        har = HarArchive(path, match=('method', 'url'))
+        session = self.ghost.start(har=har)
+        replayed, _ = session.open("%secho/recorded" % base_url)
+        self.assertEqual(replayed.http_status, 200)
+        self.assertEqual(replayed.content, page.content)
+        self.assertEqual(har.misses, 0)
+        session.open("%secho/unrecorded" % base_url)
+        self.assertEqual(har.misses, 1)
+        self.assertEqual(
+            har.missed, [('GET', "%secho/unrecorded" % base_url)])
+        self.assertFalse(
+            any(resource.blocked for resource in session.waterfall.resources))
+        session.exit()
+
     def _assert_viewport_width(self, session, width):
         self.assertEqual(session.main_frame.contentsSize().width(), width)
         self.assertEqual(session.page.viewportSize().width(), width)